@@ -0,0 +1,303 @@
+#
+# Scanvark -- a Gtk-based batch scanning program
+#
+# Copyright (c) 2012 Benjamin Gilbert
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import division
+from collections import deque
+from functools import wraps
+import glib
+import gobject
+import gtk
+import logging
+import threading
+import time
+
+from .config import ScanvarkConfig
+from .models import PageList, SaveList
+from .page import set_pre_encode_paused
+from .save import SaveScheduler, SaveThread, init_encoders
+from .scanner import ScannerThread
+from .store import PageStore
+from .ui import MainWindow, PageWindow, ErrorDialog
+
+_log = logging.getLogger(__name__)
+
+class _UIDispatcher(object):
+    '''Queue calls from other threads and run them on the UI thread from a
+    single idle handler, rather than waking the main loop once per call.
+    A call with a coalescing key replaces the arguments of a queued call
+    with the same key.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # [key, function, args, time queued]
+        self._queue = deque()
+        # key -> queue entry
+        self._pending = {}
+        self._idle_id = None
+        self._wakeups = 0
+        self._calls = 0
+        self._coalesced = 0
+        self._max_depth = 0
+        self._total_latency = 0
+        self._max_latency = 0
+
+    def call(self, f, args, key=None):
+        with self._lock:
+            entry = self._pending.get(key) if key is not None else None
+            if entry is not None:
+                # Keep the original queue time, so latency reflects how
+                # long the oldest update waited
+                entry[2] = args
+                self._coalesced += 1
+            else:
+                entry = [key, f, args, time.time()]
+                self._queue.append(entry)
+                if key is not None:
+                    self._pending[key] = entry
+                self._max_depth = max(self._max_depth, len(self._queue))
+            if self._idle_id is None:
+                self._idle_id = glib.idle_add(self._dispatch)
+
+    # We intentionally catch all exceptions
+    # pylint: disable=W0703
+    def _dispatch(self):
+        # Take entries off the queue one at a time, so that if a callback
+        # runs a nested main loop, a dispatch from within that loop
+        # continues with the next entry rather than overtaking it.  Stop
+        # after the entries that were queued when we started, so a busy
+        # producer can't starve the main loop.
+        with self._lock:
+            self._idle_id = None
+            self._wakeups += 1
+            remaining = len(self._queue)
+        while remaining:
+            remaining -= 1
+            with self._lock:
+                if not self._queue:
+                    break
+                key, f, args, queued = self._queue.popleft()
+                if key is not None:
+                    del self._pending[key]
+                latency = time.time() - queued
+                self._total_latency += latency
+                self._max_latency = max(self._max_latency, latency)
+                self._calls += 1
+            try:
+                f(*args)
+            except Exception:
+                _log.exception('UI callback %s failed', f.__name__)
+        return False
+    # pylint: enable=W0703
+
+    @property
+    def stats(self):
+        '''Counters for monitoring back-pressure on the UI thread.  Latency
+        is in seconds.'''
+        with self._lock:
+            return {
+                'depth': len(self._queue),
+                'max-depth': self._max_depth,
+                'wakeups': self._wakeups,
+                'calls': self._calls,
+                'coalesced': self._coalesced,
+                'mean-latency': self._total_latency / max(self._calls, 1),
+                'max-latency': self._max_latency,
+            }
+
+_dispatcher = _UIDispatcher()
+
+def _ui_callback(f, coalesce=False):
+    '''Arrange for the function to be invoked as a callback on the UI
+    thread.  Can be used as a decorator.  If coalesce is true, a queued
+    call is replaced by a later call with the same first argument.'''
+    @wraps(f)
+    def wrapper(*args):
+        key = (f, args[0]) if coalesce and args else None
+        _dispatcher.call(f, args, key)
+    return wrapper
+
+class Scanvark(object):
+    def __init__(self, conffile):
+        gobject.threads_init()
+        self._config = ScanvarkConfig(conffile)
+        # Fork the encoder processes before we start any threads
+        init_encoders(self._config)
+        self._store = PageStore(self._config)
+        self._pagelist = PageList(self._config)
+        self._savelist = SaveList()
+        self._save_scheduler = SaveScheduler(self._config)
+        self._main_window = MainWindow(self._config, self._pagelist,
+                self._savelist)
+        self._page_windows = {}
+        self._scanners = [ScannerThread(self._config, device, self._store,
+                scan_status_callback=_ui_callback(
+                        lambda running, device=device:
+                        self._set_scan_running(device, running)),
+                page_callback=
+                        _ui_callback(self._pagelist.add_page),
+                error_callback=_ui_callback(
+                        lambda message, device=device:
+                        self._show_scanner_error(device, message)),
+        ) for device in self._config.devices]
+        # Names of devices currently scanning
+        self._scanning = set()
+
+        self._main_window.connect('delete-event', gtk.main_quit)
+
+        self._main_window.connect('scan',
+                lambda _wid: self._scan())
+        self._main_window.connect('save',
+                lambda _wid, f, p: self._save_document(f, p))
+        self._main_window.connect('save-cancelled',
+                lambda _wid, thread: self._cancel_save(thread))
+        self._main_window.connect('save-retried',
+                lambda _wid, thread: self._retry_save(thread))
+        self._main_window.connect('save-prioritized',
+                lambda _wid, thread: self._save_scheduler.prioritize(thread))
+        self._main_window.connect('settings-changed',
+                lambda _wid: self._copy_settings_to_scanners())
+        self._main_window.connect('page-opened',
+                lambda _wid, page: self._open_page(page))
+
+        self._pagelist.connect('page-removed',
+                lambda _model, page: self._close_page(page))
+
+        self._copy_settings_to_scanners()
+
+    def run(self):
+        for scanner in self._scanners:
+            scanner.start()
+        self._main_window.show()
+        try:	
+            gtk.main()
+        finally:
+            for scanner in self._scanners:
+                scanner.stop()
+            for scanner in self._scanners:
+                scanner.join()
+            self._store.close()
+
+    def _scan(self):
+        # Start every scanner that isn't already busy
+        for scanner in self._scanners:
+            if scanner.device.name not in self._scanning:
+                scanner.scan()
+
+    def _save_document(self, filename, page_paths):
+        pages = self._pagelist.remove_pages(page_paths)
+
+        thread = SaveThread(self._config, filename, pages,
+                progress_callback=_ui_callback(self._savelist.progress,
+                        coalesce=True),
+                success_callback=self._handle_save_success,
+                error_callback=self._handle_save_error)
+        self._savelist.add_thread(thread)
+        self._save_scheduler.submit(thread)
+
+    @_ui_callback
+    def _handle_save_success(self, thread):
+        self._savelist.remove_thread(thread)
+        self._save_scheduler.finished(thread)
+
+    @_ui_callback
+    def _handle_save_error(self, thread, message):
+        self._save_scheduler.finished(thread)
+        if thread.cancelled:
+            self._restore_save_pages(thread)
+        else:
+            # Leave the job in the save list so it can be retried or
+            # cancelled
+            self._savelist.thread_changed(thread)
+            self._show_error("Couldn't save file: %s" % message)
+
+    def _retry_save(self, thread):
+        if thread.error is None:
+            return
+        new = thread.retry()
+        self._savelist.replace_thread(thread, new)
+        self._save_scheduler.submit(new, new.priority)
+
+    def _cancel_save(self, thread):
+        if thread.error is not None:
+            # Failed job
+            thread.discard()
+            self._restore_save_pages(thread)
+        elif self._save_scheduler.cancel(thread):
+            # Never started
+            self._restore_save_pages(thread)
+
+    def _restore_save_pages(self, thread):
+        # Restore pages to page list
+        for page in thread.pages:
+            self._pagelist.append_page(page)
+        self._savelist.remove_thread(thread)
+
+    def _set_scan_running(self, device, running):
+        if running:
+            self._scanning.add(device.name)
+        else:
+            self._scanning.discard(device.name)
+            self._pagelist.end_scan(device.name)
+        running = bool(self._scanning)
+        self._main_window.set_scan_running(running)
+        self._save_scheduler.set_scanning(running)
+        # Leave the CPU to the scan
+        set_pre_encode_paused(running)
+
+    @property
+    def ui_stats(self):
+        return _dispatcher.stats
+
+    @property
+    def button_stats(self):
+        return dict((scanner.device.name, scanner.button_stats)
+                for scanner in self._scanners)
+
+    def _show_error(self, message):
+        # Don't block in a nested main loop, which would let later
+        # callbacks run before this one returns
+        dlg = ErrorDialog(self._main_window, message)
+        dlg.connect('response', lambda dlg, _response: dlg.destroy())
+        dlg.show()
+
+    def _show_scanner_error(self, device, message):
+        if len(self._scanners) > 1:
+            message = '%s: %s' % (device.name, message)
+        self._show_error(message)
+
+    def _copy_settings_to_scanners(self):
+        resolution, color, double_sided = self._main_window.get_settings()
+        for scanner in self._scanners:
+            scanner.resolution = resolution
+            scanner.color = color
+            scanner.double_sided = double_sided
+
+    def _open_page(self, page):
+        if page not in self._page_windows:
+            window = PageWindow(page)
+            window.connect('closed',
+                    lambda wid: self._close_page(wid.page))
+            self._page_windows[page] = window
+        self._page_windows[page].present()
+
+    def _close_page(self, page):
+        try:
+            self._page_windows.pop(page).destroy()
+        except KeyError:
+            pass
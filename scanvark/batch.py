@@ -0,0 +1,212 @@
+#
+# Scanvark -- a Gtk-based batch scanning program
+#
+# Copyright (c) 2012 Benjamin Gilbert
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''Scanning without a user interface.  Nothing here may import gtk.'''
+
+from __future__ import division
+from datetime import datetime
+import Queue
+import sys
+
+from .config import ScanvarkConfig
+from .page import set_pre_encode_paused
+from .save import SaveScheduler, SaveThread, init_encoders
+from .scanner import ScannerThread
+from .store import PageStore
+
+class BatchScanner(object):
+    '''Scan one or more feeder loads and save them as PDFs.  Each load
+    becomes one document, or is split into documents of pages_per_document
+    pages.  Document names are made by formatting output with n (the
+    document number, starting from 1) and time (when the load started
+    scanning), e.g. "scan-{time:%Y%m%d}-{n:03d}".  ".pdf" is appended.'''
+
+    # Seconds between checks that the scanner thread is still alive
+    POLL_INTERVAL = 1
+
+    def __init__(self, conffile, output, pages_per_document=None,
+            batches=1, device=None, resolution=None, color=None,
+            double_sided=None):
+        self._config = ScanvarkConfig(conffile)
+        if device is None:
+            device = self._config.devices[0]
+        else:
+            try:
+                device = [d for d in self._config.devices
+                        if d.name == device][0]
+            except IndexError:
+                raise ValueError('No such device: %s' % device)
+        self._output = output
+        self._pages_per_document = pages_per_document
+        # 0 means until interrupted
+        self._batches = batches
+        # Fork the encoder processes before we start any threads
+        init_encoders(self._config)
+        self._store = PageStore(self._config)
+        self._save_scheduler = SaveScheduler(self._config)
+        self._saving = set()
+        self._documents = 0
+        self._failed = 0
+        self._scan_errors = 0
+        # Save jobs which are retries of failed ones
+        self._retries = set()
+        self._pages = []
+        self._started = datetime.now()
+        self._running = False
+        self._completed_batches = 0
+
+        # Events from the worker threads, handled on the main thread in
+        # the order they occurred
+        self._events = Queue.Queue()
+        self._scanner = ScannerThread(self._config, device, self._store,
+                scan_status_callback=self._post(self._set_scan_running),
+                page_callback=self._post(self._add_page),
+                error_callback=self._post(self._handle_scan_error))
+        self._scanner.resolution = (resolution or
+                self._config.default_resolution)
+        self._scanner.color = (color if color is not None else
+                self._config.default_color)
+        self._scanner.double_sided = (double_sided if double_sided is not
+                None else self._config.default_double_sided)
+
+    def _post(self, f):
+        '''Return a callback which has f called on the main thread.'''
+        return lambda *args: self._events.put((f, args))
+
+    def run(self):
+        '''Scan, save, and return the number of scan errors plus the
+        number of documents that could not be saved.'''
+        self._scanner.start()
+        # The first load is started right away; later ones by the
+        # scanner's button
+        self._scanner.scan()
+        try:
+            try:
+                while not self._done_scanning():
+                    self._handle_event()
+            except KeyboardInterrupt:
+                self._log('Interrupted; saving scanned pages')
+            self._scanner.stop()
+            self._scanner.join()
+            # Collect any pages delivered before the scanner stopped
+            while not self._events.empty():
+                self._handle_event()
+            self._finish_batch()
+            while self._saving:
+                self._handle_event()
+        finally:
+            self._scanner.stop()
+            self._scanner.join()
+            self._store.close()
+        return self._scan_errors + self._failed
+
+    def _done_scanning(self):
+        if self._batches and self._completed_batches >= self._batches:
+            return True
+        # The scanner thread exits on its own if SANE can't be
+        # initialized
+        return not self._scanner.is_alive() and self._events.empty()
+
+    def _handle_event(self):
+        try:
+            f, args = self._events.get(timeout=self.POLL_INTERVAL)
+        except Queue.Empty:
+            return
+        f(*args)
+
+    def _set_scan_running(self, running):
+        self._save_scheduler.set_scanning(running)
+        # Leave the CPU to the scan
+        set_pre_encode_paused(running)
+        if running:
+            self._started = datetime.now()
+            self._log('Scanning')
+        elif self._running:
+            self._finish_batch()
+            self._completed_batches += 1
+            if (not self._batches or
+                    self._completed_batches < self._batches):
+                self._log('Waiting for scan button')
+        self._running = running
+
+    def _handle_scan_error(self, message):
+        self._scan_errors += 1
+        self._log(message)
+
+    def _add_page(self, page):
+        if self._config.prepend_new_pages:
+            # The document's page order is only known once the whole load
+            # has been scanned
+            self._pages.insert(0, page)
+        else:
+            self._pages.append(page)
+            if (self._pages_per_document and
+                    len(self._pages) >= self._pages_per_document):
+                self._save(self._pages)
+                self._pages = []
+
+    def _finish_batch(self):
+        pages, self._pages = self._pages, []
+        size = self._pages_per_document or len(pages)
+        for i in range(0, len(pages), max(size, 1)):
+            self._save(pages[i:i + size])
+
+    def _save(self, pages):
+        self._documents += 1
+        filename = self._output.format(n=self._documents,
+                time=self._started)
+        thread = SaveThread(self._config, filename, pages,
+                progress_callback=lambda *args: None,
+                success_callback=self._post(self._handle_save_success),
+                error_callback=self._post(self._handle_save_error))
+        self._saving.add(thread)
+        self._save_scheduler.submit(thread)
+
+    def _handle_save_success(self, thread):
+        self._save_scheduler.finished(thread)
+        self._saving.discard(thread)
+        self._retries.discard(thread)
+        thread.join()
+        self._log('Saved %s.pdf (%d pages)' % (thread.filename,
+                len(thread.pages)))
+
+    def _handle_save_error(self, thread, message):
+        self._save_scheduler.finished(thread)
+        self._saving.discard(thread)
+        thread.join()
+        self._log("Couldn't save %s.pdf: %s" % (thread.filename, message))
+        if thread not in self._retries:
+            # Try once more, resuming from the last page written
+            self._log('Retrying %s.pdf' % thread.filename)
+            new = thread.retry()
+            self._retries.add(new)
+            self._saving.add(new)
+            self._save_scheduler.submit(new, new.priority)
+            return
+        self._retries.discard(thread)
+        self._failed += 1
+        self._log('Giving up on %s.pdf; its %d pages are lost' %
+                (thread.filename, len(thread.pages)))
+        thread.discard()
+        for page in thread.pages:
+            page.finish()
+
+    @staticmethod
+    def _log(message):
+        print >> sys.stderr, message
@@ -0,0 +1,135 @@
+#
+# Scanvark -- a Gtk-based batch scanning program
+#
+# Copyright (c) 2012 Benjamin Gilbert
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import division
+import threading
+import time
+
+class ButtonNotifier(object):
+    '''Watches a scanner's hardware scan button.  Subclasses detect
+    presses by polling or by some other means, and are selected with the
+    "button" configuration setting.'''
+
+    def __init__(self, config, device):
+        self._config = config
+        self.device = device
+        self._lock = threading.Lock()
+        self._polls = 0
+        self._poll_time = 0
+        self._presses = 0
+        self._total_latency = 0
+        self._max_latency = 0
+
+    def wait(self, session, start):
+        '''Wait until the button is pressed or the start event is set,
+        returning after at most a few seconds either way so the caller can
+        do housekeeping.  Return True if the button was pressed.  Raises
+        ScanError if the scanner goes away.'''
+        raise NotImplementedError()
+
+    def activity(self):
+        '''Notify the notifier that a scan has just finished.'''
+        pass
+
+    def _record_poll(self, elapsed):
+        with self._lock:
+            self._polls += 1
+            self._poll_time += elapsed
+
+    def _record_press(self, latency):
+        '''Record a button press detected at most latency seconds after
+        it happened.'''
+        with self._lock:
+            self._presses += 1
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+
+    @property
+    def stats(self):
+        '''Button polling statistics.  Latencies are upper bounds on the
+        time between a press and its detection.'''
+        with self._lock:
+            return {
+                'polls': self._polls,
+                'poll-time': self._poll_time,
+                'presses': self._presses,
+                'mean-latency': self._total_latency / max(self._presses, 1),
+                'max-latency': self._max_latency,
+            }
+
+
+class PollingButtonNotifier(ButtonNotifier):
+    '''Poll the button, quickly just after a scan or button press and
+    progressively more slowly while the scanner sits idle.'''
+
+    # Factor by which the interval grows at each idle poll
+    BACKOFF = 1.25
+    # Seconds after activity during which we poll at the minimum interval
+    ACTIVE_PERIOD = 30
+
+    def __init__(self, config, device):
+        ButtonNotifier.__init__(self, config, device)
+        self._interval = config.button_poll_min
+        self._last_activity = time.time()
+
+    def wait(self, session, start):
+        if start.wait(self._interval):
+            return False
+        begin = time.time()
+        pressed = session.scan_button
+        now = time.time()
+        self._record_poll(now - begin)
+        if pressed:
+            self._record_press(self._interval)
+            self.activity()
+        elif now - self._last_activity > self.ACTIVE_PERIOD:
+            self._interval = min(self._interval * self.BACKOFF,
+                    self._config.button_poll_max)
+        return pressed
+
+    def activity(self):
+        self._interval = self._config.button_poll_min
+        self._last_activity = time.time()
+
+
+class ManualButtonNotifier(ButtonNotifier):
+    '''Ignore the hardware button; scans are only started from software.'''
+
+    def wait(self, session, start):
+        start.wait(1)
+        return False
+
+
+_notifiers = {
+    'poll': PollingButtonNotifier,
+    'none': ManualButtonNotifier,
+}
+
+def get_notifier_class(name):
+    '''Return the ButtonNotifier subclass with the given short name, or
+    named by a dotted module path.'''
+    try:
+        return _notifiers[name]
+    except KeyError:
+        pass
+    module_name, _dot, class_name = name.rpartition('.')
+    if not module_name:
+        raise ValueError('Unknown button notifier: %s' % name)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
@@ -20,27 +20,119 @@
 from __future__ import division
 import yaml
 
+def _get_rotation(config, key, default=0):
+    return config.get(key, config.get('rotate', default))
+
+
+class DeviceConfig(object):
+    '''Settings for one scanner.  Settings not given for the device are
+    taken from the top level of the configuration file.'''
+
+    def __init__(self, config, defaults):
+        if not isinstance(config, dict):
+            config = {'device': config}
+        # "sane", or "simulated" for a synthetic scanner configured by
+        # the simulation settings
+        self.backend = config.get('backend', defaults.get('backend', 'sane'))
+        self.device = config.get('device', None)
+        if self.device is None and self.backend == 'sane':
+            raise ValueError('No device configured')
+        # Label for pages from this scanner
+        self.name = config.get('name', self.device or self.backend)
+        self.simulation = dict(defaults.get('simulation', {}))
+        self.simulation.update(config.get('simulation', {}))
+        self.device_config = dict(defaults.get('scan-settings', {}))
+        self.device_config.update(config.get('scan-settings', {}))
+
+        self.source_single = config.get('single-source',
+                defaults.get('single-source', None))
+        self.source_double = config.get('double-source',
+                defaults.get('double-source', None))
+
+        # How to watch the scan button: "poll", "none", or the dotted
+        # name of a ButtonNotifier subclass
+        self.button = config.get('button', defaults.get('button', 'poll'))
+
+        self.rotate_odd = _get_rotation(config, 'rotate-odd',
+                _get_rotation(defaults, 'rotate-odd'))
+        self.rotate_even = _get_rotation(config, 'rotate-even',
+                _get_rotation(defaults, 'rotate-even'))
+
+
 class ScanvarkConfig(object):
     def __init__(self, conffile):
         with open(conffile) as fh:
             config = yaml.safe_load(fh)
 
-        self.device = config['device']
-        self.device_config = config.get('scan-settings', {})
+        # Either a single "device", or a list of "devices", each a device
+        # string or a dict of per-device settings
+        devices = config.get('devices', None)
+        if devices is None:
+            devices = [config.get('device', None)]
+        if not devices:
+            raise ValueError('No devices configured')
+        self.devices = [DeviceConfig(d, config) for d in devices]
+        if len(set(d.name for d in self.devices)) != len(self.devices):
+            raise ValueError('Device names must be unique')
 
-        self.source_single = config.get('single-source', None)
-        self.source_double = config.get('double-source', None)
+        # Seconds between polls of the scan button just after activity, and
+        # after the scanner has been idle for a while
+        self.button_poll_min = config.get('button-poll-min', 0.05)
+        self.button_poll_max = config.get('button-poll-max', 1)
+
+        # Maximum length of a dynamic-length page, in inches
+        self.max_page_length = config.get('max-page-length', 20)
 
         self.prepend_new_pages = config.get('page-order') == 'reverse'
-        def get_rotation(key):
-            val = config.get('rotate', 0)
-            return config.get(key, val)
-        self.rotate_odd = get_rotation('rotate-odd')
-        self.rotate_even = get_rotation('rotate-even')
+
+        # Number of threads converting scanned images into pages, and the
+        # number of scanned images allowed to wait for them
+        self.page_workers = config.get('page-workers', 2)
+        self.page_queue_size = config.get('page-queue-size', 2)
+
+        # What to do with pages that appear to be blank: "keep", "flag"
+        # (keep, but fade the thumbnail), or "drop".  Dropping is opt-in,
+        # since pages with very little ink look blank.  A page is blank if
+        # less than blank-threshold of its area, ignoring a blank-margin
+        # (in inches) around the edges, is ink.
+        self.blank_pages = config.get('blank-pages', 'keep')
+        if self.blank_pages not in ('keep', 'flag', 'drop'):
+            raise ValueError('blank-pages must be "keep", "flag", or "drop"')
+        self.blank_threshold = config.get('blank-threshold', 0.002)
+        self.blank_margin = config.get('blank-margin', 0.25)
 
         self.jpeg_quality = config.get('jpeg-quality', 95)
+        # Save grayscale and black-and-white pages in cheaper formats.  Off
+        # by default since it's lossy: faint color marks can be dropped
+        # and black-and-white pages are thresholded to 1 bit.
+        self.adaptive_compression = config.get('adaptive-compression',
+                False)
+
+        # Number of documents saved at once, normally and while scanning
+        self.save_jobs = config.get('save-jobs', 2)
+        self.save_jobs_while_scanning = config.get('save-jobs-while-scanning',
+                1)
+
+        # Seconds a page must sit unchanged before it is JPEG-encoded in the
+        # background, ready for saving.  null disables pre-encoding.
+        self.pre_encode_delay = config.get('pre-encode-delay', 5)
+
+        # Number of processes encoding pages for PDF export.  By default,
+        # one per CPU.
+        self.save_processes = config.get('save-processes', None)
+
+        # Where and how page images are kept until they are saved.
+        # compression is "none" for speed, or "png" with a zlib level.
+        store = config.get('page-store', {})
+        self.store_directory = store.get('directory', None)
+        self.store_compression = store.get('compression', 'none')
+        self.store_compression_level = store.get('level', 1)
 
         self.thumbnail_size = config.get('thumbnail-size', (200, 150))
+        # Maximum number of thumbnails kept in memory.  The cache grows
+        # beyond this if needed to hold the visible thumbnails plus 50
+        # prefetched on either side.
+        self.thumbnail_cache_size = config.get('thumbnail-cache-size', 500)
 
         defaults = config.get('defaults', {})
         self.default_color = defaults.get('color', True)
@@ -18,23 +18,164 @@
 #
 
 from __future__ import division
+from collections import deque, OrderedDict
+import glib
 import gobject
 import gtk
+import threading
+
+def pixbuf_from_array(arr):
+    '''Convert an RGB array from a Page into a pixbuf.'''
+    return gtk.gdk.pixbuf_new_from_array(arr, gtk.gdk.COLORSPACE_RGB, 8)
+
+
+class _ThumbnailCache(threading.Thread):
+    '''LRU cache of thumbnail pixbufs keyed by page, rotation, and size.
+    Missing thumbnails are rendered on a background thread and passed in
+    batches to a callback on the UI thread, along with the entries evicted
+    to make room for them.'''
+
+    # Maximum thumbnails rendered before delivering a batch
+    BATCH_SIZE = 20
+
+    def __init__(self, callback, capacity):
+        threading.Thread.__init__(self, name='thumbnails')
+        self.daemon = True
+        self._callback = callback
+        self._capacity = capacity
+        self._cond = threading.Condition()
+        # Pages still to be rendered, as (page, size)
+        self._wanted = deque()
+        # Pages forgotten while their thumbnails were being rendered
+        self._forgotten = set()
+        # (page, rotation, size) -> pixbuf, least recently used first
+        self._cache = OrderedDict()
+
+    def lookup(self, page, size):
+        '''Return the cached thumbnail for the page's current rotation, or
+        None.'''
+        key = (page, page.rotation, size)
+        with self._cond:
+            pixbuf = self._cache.pop(key, None)
+            if pixbuf is not None:
+                # Mark as recently used
+                self._cache[key] = pixbuf
+            return pixbuf
+
+    def request(self, pages, size):
+        '''Render thumbnails for the pages, in order, replacing any requests
+        that haven't been started yet.'''
+        with self._cond:
+            self._wanted = deque((page, size) for page in pages)
+            self._forgotten.difference_update(pages)
+            self._cond.notify()
+
+    def reserve(self, count):
+        '''Make sure the cache can hold at least count thumbnails, so that
+        the rows being shown don't evict each other.'''
+        with self._cond:
+            self._capacity = max(self._capacity, count)
+
+    def forget(self, page):
+        '''Drop the page's thumbnails and any pending requests for them.'''
+        with self._cond:
+            for key in [key for key in self._cache if key[0] is page]:
+                del self._cache[key]
+            self._wanted = deque((p, size) for p, size in self._wanted
+                    if p is not page)
+            self._forgotten.add(page)
+
+    # We intentionally catch all exceptions
+    # pylint: disable=W0703
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._wanted:
+                    self._cond.wait()
+                # Forgotten pages have already been dropped from the
+                # queue; we only need to watch for the ones forgotten
+                # while this batch is rendered
+                self._forgotten.clear()
+                requests = []
+                while self._wanted and len(requests) < self.BATCH_SIZE:
+                    requests.append(self._wanted.popleft())
+            results = []
+            evicted = []
+            for page, size in requests:
+                rotation = page.rotation
+                key = (page, rotation, size)
+                with self._cond:
+                    if key in self._cache or page in self._forgotten:
+                        continue
+                try:
+                    if tuple(page.thumbnail_size) != size:
+                        page.set_thumbnail_size(size)
+                    pixbuf = pixbuf_from_array(
+                            page.get_thumbnail_array(rotation))
+                except Exception:
+                    # Page was deleted while we were working on it
+                    continue
+                with self._cond:
+                    if page in self._forgotten:
+                        continue
+                    self._cache[key] = pixbuf
+                    while len(self._cache) > self._capacity:
+                        (old_page, _rotation, _size), old_pixbuf = \
+                                self._cache.popitem(last=False)
+                        evicted.append((old_page, old_pixbuf))
+                results.append((page, rotation, size, pixbuf))
+            if results or evicted:
+                glib.idle_add(self._callback, results, evicted)
+    # pylint: enable=W0703
+
 
 class _ListStore(gtk.ListStore):
-    def _find_value(self, column, value):
+    '''ListStore which can find the row containing a given object in its key
+    column without searching.  Rows are tracked with TreeRowReferences,
+    which follow them across insertions, deletions, and drag reordering.'''
+
+    def __init__(self, key_column, *types):
+        gtk.ListStore.__init__(self, *types)
+        self._key_column = key_column
+        # key object -> TreeRowReference
+        self._index = {}
+        # Reordering by drag and drop copies the row and then deletes the
+        # original, so reindex whenever a key is stored
+        self.connect('row-changed', self._row_changed)
+
+    def _row_changed(self, _model, path, iter):
+        value = self.get_value(iter, self._key_column)
+        if value is None:
+            return
+        ref = self._index.get(value)
+        if ref is None or not ref.valid() or ref.get_path() != path:
+            self._index[value] = gtk.TreeRowReference(self, path)
+
+    def _find_value(self, value):
+        ref = self._index.get(value)
+        if ref is not None and ref.valid():
+            iter = self.get_iter(ref.get_path())
+            if self.get_value(iter, self._key_column) is value:
+                return iter
+        # Index is stale; fall back to searching
         iter = self.get_iter_first()
         while iter is not None:
-            if self.get_value(iter, column) is value:
+            if self.get_value(iter, self._key_column) is value:
+                self._index[value] = gtk.TreeRowReference(self,
+                        self.get_path(iter))
                 return iter
             iter = self.iter_next(iter)
         raise KeyError()
 
+    def _forget_value(self, value):
+        self._index.pop(value, None)
+
 
 class PageList(_ListStore):
     PAGE_COLUMN = 0
     PIXBUF_COLUMN = 1
-    _HANDLER_ID_COLUMN = 2
+    SOURCE_COLUMN = 2
+    _HANDLER_ID_COLUMN = 3
 
     __gsignals__ = {
         'page-removed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
@@ -42,19 +183,66 @@ class PageList(_ListStore):
     }
 
     def __init__(self, config):
-        _ListStore.__init__(self, object, gtk.gdk.Pixbuf, gobject.TYPE_INT)
+        _ListStore.__init__(self, self.PAGE_COLUMN, object, gtk.gdk.Pixbuf,
+                gobject.TYPE_STRING, gobject.TYPE_INT)
         self._config = config
+        # source -> page most recently added by the running scan
+        self._scan_runs = {}
+        self.thumbnail_size = tuple(config.thumbnail_size)
+        self._thumbnails = _ThumbnailCache(self._install_thumbnails,
+                config.thumbnail_cache_size)
+        self._thumbnails.start()
+        # size -> placeholder pixbuf
+        self._placeholders = {}
+
+    def _get_placeholder(self, page):
+        '''Return a blank pixbuf the size of the page's thumbnail.'''
+        w, h = page.size
+        scale = min(self.thumbnail_size[0] / w, self.thumbnail_size[1] / h,
+                1)
+        size = (max(int(w * scale), 1), max(int(h * scale), 1))
+        if size not in self._placeholders:
+            pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, *size)
+            pixbuf.fill(0xd0d0d0ff)
+            self._placeholders[size] = pixbuf
+        return self._placeholders[size]
+
+    def _get_thumbnail(self, page):
+        '''Return the page's thumbnail if it's cached, or a placeholder.
+        Thumbnails are only rendered when the view asks for them with
+        load_thumbnails().'''
+        pixbuf = self._thumbnails.lookup(page, self.thumbnail_size)
+        if pixbuf is None:
+            pixbuf = self._get_placeholder(page)
+        return pixbuf
 
     def _page_columns(self, page):
         handler_id = page.connect('changed', self._page_changed)
-        return [page, page.thumbnail_pixbuf, handler_id]
+        return [page, self._get_thumbnail(page), page.source, handler_id]
 
     def add_page(self, page):
+        '''Add a newly-scanned page.  Pages from one scan are kept together
+        even if other scanners are adding pages at the same time.'''
+        columns = self._page_columns(page)
+        try:
+            iter = self._find_value(self._scan_runs[page.source])
+        except KeyError:
+            iter = None
         if self._config.prepend_new_pages:
-            func = self.prepend
+            if iter is None:
+                self.prepend(columns)
+            else:
+                self.insert_before(iter, columns)
         else:
-            func = self.append
-        func(self._page_columns(page))
+            if iter is None:
+                self.append(columns)
+            else:
+                self.insert_after(iter, columns)
+        self._scan_runs[page.source] = page
+
+    def end_scan(self, source):
+        '''Start a new group of pages with the next page from source.'''
+        self._scan_runs.pop(source, None)
 
     def append_page(self, page):
         self.append(self._page_columns(page))
@@ -68,10 +256,86 @@ class PageList(_ListStore):
         page.disconnect(self.get_value(iter, self._HANDLER_ID_COLUMN))
         self.emit('page-removed', page)
         self.remove(iter)
+        self._forget_value(page)
+        if self._scan_runs.get(page.source) is page:
+            del self._scan_runs[page.source]
+        self._thumbnails.forget(page)
+
+    def remove_pages(self, paths):
+        '''Remove several pages and return them in path order.'''
+        pages = [self.get_page(path) for path in sorted(paths)]
+        # Remove from the end so the remaining paths stay valid
+        for path in sorted(paths, reverse=True):
+            self.remove_page(path)
+        return pages
+
+    def rotate_pages(self, paths, degrees):
+        '''Rotate several pages, then install their thumbnails from the
+        cache or regenerate them in the background.'''
+        for path in paths:
+            iter = self.get_iter(path)
+            page = self.get_value(iter, self.PAGE_COLUMN)
+            handler_id = self.get_value(iter, self._HANDLER_ID_COLUMN)
+            page.handler_block(handler_id)
+            try:
+                page.rotate(degrees)
+            finally:
+                page.handler_unblock(handler_id)
+            self.set_value(iter, self.PIXBUF_COLUMN,
+                    self._get_thumbnail(page))
+
+    def set_thumbnail_size(self, size):
+        self.thumbnail_size = tuple(size)
+        for row in self:
+            row[self.PIXBUF_COLUMN] = self._get_thumbnail(
+                    row[self.PAGE_COLUMN])
+
+    def load_thumbnails(self, start, end, margin):
+        '''Show thumbnails for rows start through end, and for margin rows
+        on either side.  Thumbnails which aren't cached are rendered in the
+        background, visible rows first.'''
+        indexes = (range(start, end + 1) +
+                range(end + 1, end + 1 + margin) +
+                range(start - 1, start - 1 - margin, -1))
+        self._thumbnails.reserve(len(indexes))
+        missing = []
+        for index in indexes:
+            if index < 0 or index >= len(self):
+                continue
+            iter = self.get_iter((index,))
+            page = self.get_value(iter, self.PAGE_COLUMN)
+            pixbuf = self._thumbnails.lookup(page, self.thumbnail_size)
+            if pixbuf is None:
+                missing.append(page)
+            elif self.get_value(iter, self.PIXBUF_COLUMN) is not pixbuf:
+                self.set_value(iter, self.PIXBUF_COLUMN, pixbuf)
+        self._thumbnails.request(missing, self.thumbnail_size)
+
+    def _install_thumbnails(self, results, evicted):
+        # Drop evicted thumbnails from the model so they can be freed
+        for page, pixbuf in evicted:
+            try:
+                iter = self._find_value(page)
+            except KeyError:
+                continue
+            if self.get_value(iter, self.PIXBUF_COLUMN) is pixbuf:
+                self.set_value(iter, self.PIXBUF_COLUMN,
+                        self._get_placeholder(page))
+        for page, rotation, size, pixbuf in results:
+            if rotation != page.rotation or size != self.thumbnail_size:
+                # Stale
+                continue
+            try:
+                iter = self._find_value(page)
+            except KeyError:
+                # Page was removed in the meantime
+                continue
+            self.set_value(iter, self.PIXBUF_COLUMN, pixbuf)
+        return False
 
     def _page_changed(self, page):
-        iter = self._find_value(self.PAGE_COLUMN, page)
-        self.set_value(iter, self.PIXBUF_COLUMN, page.thumbnail_pixbuf)
+        iter = self._find_value(page)
+        self.set_value(iter, self.PIXBUF_COLUMN, self._get_thumbnail(page))
 
 
 class SaveList(_ListStore):
@@ -80,17 +344,30 @@ class SaveList(_ListStore):
     TOTAL_COLUMN = 2
 
     def __init__(self):
-        _ListStore.__init__(self, object, gobject.TYPE_INT,
-                gobject.TYPE_INT)
+        _ListStore.__init__(self, self.THREAD_COLUMN, object,
+                gobject.TYPE_INT, gobject.TYPE_INT)
 
     def add_thread(self, thread):
         self.append([thread, 0, 0])
 
     def progress(self, thread, count, total):
-        iter = self._find_value(self.THREAD_COLUMN, thread)
+        iter = self._find_value(thread)
         self.set_value(iter, self.COUNT_COLUMN, count)
         self.set_value(iter, self.TOTAL_COLUMN, total)
 
+    def thread_changed(self, thread):
+        iter = self._find_value(thread)
+        self.row_changed(self.get_path(iter), iter)
+
+    def replace_thread(self, old, new):
+        iter = self._find_value(old)
+        self._forget_value(old)
+        self.set_value(iter, self.THREAD_COLUMN, new)
+        if old.started:
+            old.join()
+
     def remove_thread(self, thread):
-        self.remove(self._find_value(self.THREAD_COLUMN, thread))
-        thread.join()
+        self.remove(self._find_value(thread))
+        self._forget_value(thread)
+        if thread.started:
+            thread.join()
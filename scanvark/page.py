@@ -20,51 +20,223 @@
 from __future__ import division
 from cStringIO import StringIO
 import gobject
-import gtk
 import numpy
 from PIL import Image
-from tempfile import TemporaryFile
+import threading
+import time
+import zlib
+
+def _rotate_image(image, rotation):
+    if rotation == 0:
+        return image
+    elif rotation == 90:
+        return image.transpose(Image.ROTATE_90)
+    elif rotation == 180:
+        return image.transpose(Image.ROTATE_180)
+    elif rotation == 270:
+        return image.transpose(Image.ROTATE_270)
+    else:
+        raise ValueError('Illegal rotation')
+
+
+def _halve(arr):
+    '''Downsample an image array by 2 in each dimension by averaging 2x2
+    blocks.  Works on strided views, so the source is never copied.'''
+    h, w = arr.shape[0] // 2 * 2, arr.shape[1] // 2 * 2
+    total = arr[0:h:2, 0:w:2].astype(numpy.uint16)
+    total += arr[1:h:2, 0:w:2]
+    total += arr[0:h:2, 1:w:2]
+    total += arr[1:h:2, 1:w:2]
+    total += 2
+    total >>= 2
+    return total.astype(numpy.uint8)
+
+
+# A pixel whose channels differ by more than this is colored
+_COLOR_SPREAD = 32
+# Fraction of colored pixels above which a page is color
+_COLOR_FRACTION = 0.001
+# Gray levels strictly between these are midtones
+_MIDTONE_RANGE = (64, 192)
+# Fraction of midtone pixels above which a page is grayscale, not bilevel
+_MIDTONE_FRACTION = 0.03
+# Gray level at or above which a bilevel pixel is white
+_BILEVEL_THRESHOLD = 128
+
+def classify_image(image):
+    '''Return 'color', 'gray', or 'bilevel' depending on the content of the
+    image, judged from a subsample of its pixels.'''
+    w, h = image.size
+    sample = numpy.asarray(image.resize((max(w // 4, 1), max(h // 4, 1)),
+            Image.NEAREST))
+    if sample.ndim == 3:
+        spread = sample.max(2).astype(numpy.int16) - sample.min(2)
+        colored = numpy.count_nonzero(spread > _COLOR_SPREAD)
+        if colored > _COLOR_FRACTION * spread.size:
+            return 'color'
+        sample = sample[:, :, 1]
+    low, high = _MIDTONE_RANGE
+    midtones = numpy.count_nonzero((sample > low) & (sample < high))
+    if midtones > _MIDTONE_FRACTION * sample.size:
+        return 'gray'
+    return 'bilevel'
+
+
+def encode_image(path, quality, adaptive):
+    '''Load a stored page image and compress it, unrotated, for embedding
+    in a PDF.  Return (PDF filter, mode, data), where mode is '1', 'L', or
+    'RGB'.  If adaptive is true, grayscale pages are saved as grayscale
+    JPEGs and bilevel pages as compressed 1-bit images.  Takes only
+    picklable arguments so that it can run in a worker process.'''
+    image = Image.open(path)
+    kind = classify_image(image) if adaptive else 'color'
+    if kind == 'bilevel':
+        bits = image.convert('L').point(lambda v:
+                255 if v >= _BILEVEL_THRESHOLD else 0, '1')
+        # Rows of packed bits, white = 1, matching PDF's DeviceGray
+        return ('FlateDecode', '1', zlib.compress(bits.tobytes(), 6))
+    if kind == 'gray' and image.mode != 'L':
+        image = image.convert('L')
+    buf = StringIO()
+    image.save(buf, 'jpeg', quality=quality)
+    return ('DCTDecode', image.mode, buf.getvalue())
+
+
+class _PreEncoder(threading.Thread):
+    '''Encode pages in the background once they have been left alone for a
+    while, so that saving them later is fast.'''
+
+    _instance = None
+    _instance_lock = threading.Lock()
+    # Encoding is suspended while this is set, e.g. during a scan
+    _paused = False
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='pre-encoder')
+        self.daemon = True
+        self._cond = threading.Condition()
+        # page -> time at which to encode it
+        self._deadlines = {}
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def schedule(self, page, delay):
+        with self._cond:
+            self._deadlines[page] = time.time() + delay
+            self._cond.notify()
+
+    def cancel(self, page):
+        with self._cond:
+            self._deadlines.pop(page, None)
+
+    @classmethod
+    def set_paused(cls, paused):
+        with cls._instance_lock:
+            cls._paused = paused
+            instance = cls._instance
+        if instance is not None:
+            # pylint: disable=W0212
+            with instance._cond:
+                instance._cond.notify()
+
+    # We intentionally catch all exceptions
+    # pylint: disable=W0703
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if not self._deadlines or self._paused:
+                        self._cond.wait()
+                        continue
+                    page, deadline = min(self._deadlines.iteritems(),
+                            key=lambda item: item[1])
+                    if deadline <= now:
+                        del self._deadlines[page]
+                        break
+                    self._cond.wait(deadline - now)
+            try:
+                # pylint: disable=W0212
+                page._pre_encode()
+            except Exception:
+                # The cache is only an optimization
+                pass
+            del page
+    # pylint: enable=W0703
+
+
+def set_pre_encode_paused(paused):
+    '''Suspend or resume background encoding of pages.  Pages whose delay
+    expires while encoding is suspended are encoded once it resumes.'''
+    _PreEncoder.set_paused(paused)
+
 
 class Page(gobject.GObject):
     __gsignals__ = {
         'changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
-    def __init__(self, config, image, resolution, rotation=0):
+    def __init__(self, config, store, image, resolution, rotation=0,
+            source=None, blank=False):
         gobject.GObject.__init__(self)
         self._config = config
-        self._fh = TemporaryFile(prefix='scanvark-')
-        image.save(self._fh, 'ppm')
+        self._store = store
+        # Name of the scanner the page came from
+        self.source = source
+        # The scanner thought this page was blank
+        self.blank = blank
+        self.stored_image = store.add(image)
+        # Pyramid of power-of-two reductions, built on demand.  Level 0 is
+        # the scanned image.
+        self._levels = [self.stored_image]
+        self._levels_lock = threading.Lock()
 
         self.resolution = resolution
         self._size = image.size
         self._rotation = rotation
 
+        self.thumbnail_size = config.thumbnail_size
         self._thumbnail = image.copy()
-        self._thumbnail.thumbnail(config.thumbnail_size, Image.ANTIALIAS)
+        self._thumbnail.thumbnail(self.thumbnail_size, Image.ANTIALIAS)
 
-    def _get_image(self):
-        self._fh.seek(0)
-        return self._rotate_image(Image.open(self._fh))
+        # Pre-encoded image from encode_image(), as (filter, mode,
+        # StoredFile holding the data).  Rotation is applied when the page
+        # is written to the PDF, so this stays valid when the page is
+        # rotated.
+        self._encoded = None
+        self._encoded_lock = threading.Lock()
+        # Set by finish(), after which nothing more is cached
+        self._finished = False
+        self._schedule_pre_encode()
 
-    @staticmethod
-    def _make_pixbuf(image):
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        return gtk.gdk.pixbuf_new_from_array(numpy.asarray(image),
-                gtk.gdk.COLORSPACE_RGB, 8)
-
-    def _rotate_image(self, image):
-        if self._rotation == 0:
-            return image
-        elif self._rotation == 90:
-            return image.transpose(Image.ROTATE_90)
-        elif self._rotation == 180:
-            return image.transpose(Image.ROTATE_180)
-        elif self._rotation == 270:
-            return image.transpose(Image.ROTATE_270)
-        else:
-            raise ValueError('Illegal rotation')
+    def _schedule_pre_encode(self):
+        if self._config.pre_encode_delay is not None:
+            _PreEncoder.get().schedule(self, self._config.pre_encode_delay)
+
+    def _pre_encode(self):
+        # Runs in pre-encoder thread
+        with self._encoded_lock:
+            if self._finished:
+                return
+        pdf_filter, mode, data = self._encode()
+        stored = self._store.add_data(data, 'enc')
+        with self._encoded_lock:
+            # finish() may have run while we were encoding
+            if not self._finished and self._encoded is None:
+                self._encoded = (pdf_filter, mode, stored)
+                return
+        stored.unref()
+
+    def _encode(self):
+        return encode_image(self.stored_image.path,
+                self._config.jpeg_quality,
+                self._config.adaptive_compression)
 
     def rotate(self, degrees):
         if degrees % 90:
@@ -74,28 +246,111 @@ class Page(gobject.GObject):
         self._rotation -= 360 * (self._rotation // 360)
         self.emit('changed')
 
+    @property
+    def rotation(self):
+        return self._rotation
+
+    @property
+    def image_size(self):
+        '''Size of the stored image, before rotation.'''
+        return self._size
+
     @property
     def size(self):
+        return self.get_size()
+
+    def get_size(self, level=0):
+        '''Return the rotated size of the page at the given pyramid level.'''
+        w, h = [a >> level for a in self._size]
         if self._rotation % 180:
-            return reversed(self._size)
+            return (h, w)
         else:
-            return self._size
+            return (w, h)
 
-    @property
-    def pixbuf(self):
-        return self._make_pixbuf(self._get_image())
+    def get_level(self, level):
+        '''Return the stored image for the page reduced by 2**level,
+        building the pyramid as far as necessary.'''
+        with self._levels_lock:
+            while len(self._levels) <= level:
+                arr = _halve(self._levels[-1].get_array())
+                self._levels.append(self._store.add(Image.fromarray(arr)))
+            return self._levels[level]
+
+    def set_thumbnail_size(self, size):
+        '''Regenerate the thumbnail from the smallest pyramid level that is
+        at least as large as the new thumbnail.'''
+        w, h = self._size
+        scale = min(size[0] / w, size[1] / h)
+        level = 0
+        while scale * 2 ** (level + 1) <= 1 and min(w, h) >> (level + 1):
+            level += 1
+        thumbnail = self.get_level(level).load()
+        thumbnail.thumbnail(size, Image.ANTIALIAS)
+        self._thumbnail = thumbnail
+        self.thumbnail_size = size
+
+    def get_array(self, box=None, step=1, level=0, level_array=None):
+        '''Return an RGB array of the rotated page at the given pyramid
+        level, optionally cropped to box (left, top, right, bottom) and
+        taking only every step'th pixel.  The array is built straight from
+        the mapped page file, and only the requested pixels are copied.
+        Callers which already hold the unrotated array of the level, from
+        get_level(level).get_array(), can pass it as level_array to avoid
+        decoding a compressed page file again.'''
+        if level_array is None:
+            level_array = self.get_level(level).get_array()
+        arr = numpy.rot90(level_array, self._rotation // 90)
+        if box is not None:
+            left, top, right, bottom = box
+            arr = arr[top:bottom, left:right]
+        arr = arr[::step, ::step]
+        if arr.ndim == 2:
+            arr = numpy.dstack((arr, arr, arr))
+        return numpy.ascontiguousarray(arr)
+
+    def get_thumbnail_array(self, rotation):
+        '''Return an RGB array of the thumbnail with the given rotation.'''
+        image = _rotate_image(self._thumbnail, rotation)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        arr = numpy.asarray(image)
+        if self.blank:
+            # Fade out pages flagged as blank
+            arr = 255 - (255 - arr) // 3
+        return numpy.ascontiguousarray(arr, dtype=numpy.uint8)
 
     @property
-    def thumbnail_pixbuf(self):
-        return self._make_pixbuf(self._rotate_image(self._thumbnail))
+    def cached_encoding(self):
+        '''Return the pre-encoded image, or None if it isn't available.'''
+        with self._encoded_lock:
+            if self._encoded is None:
+                return None
+            pdf_filter, mode, stored = self._encoded
+            # Keep finish() from deleting the file while we read it
+            stored.ref()
+        try:
+            return (pdf_filter, mode, stored.read())
+        finally:
+            stored.unref()
 
-    def open_jpeg(self):
-        image = self._get_image()
-        buf = StringIO()
-        image.save(buf, 'jpeg', quality=self._config.jpeg_quality)
-        return StringIO(buf.getvalue())
+    def get_encoding(self):
+        '''Return the unrotated page as encoded by encode_image().'''
+        encoded = self.cached_encoding
+        if encoded is None:
+            encoded = self._encode()
+        return encoded
 
     def finish(self):
-        self._fh.close()
+        if self._config.pre_encode_delay is not None:
+            _PreEncoder.get().cancel(self)
+        with self._encoded_lock:
+            self._finished = True
+            if self._encoded is not None:
+                self._encoded[2].unref()
+                self._encoded = None
+        with self._levels_lock:
+            for image in self._levels:
+                image.unref()
+            del self._levels[:]
 
 gobject.type_register(Page)
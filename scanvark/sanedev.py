@@ -0,0 +1,128 @@
+#
+# Scanvark -- a Gtk-based batch scanning program
+#
+# Copyright (c) 2012 Benjamin Gilbert
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import division
+import sane
+import _sane
+import threading
+
+from .source import ScanError, ScanSource, trim_image
+
+# Class named according to method naming conventions.
+# pylint: disable=C0103
+class sanitize(object):
+    '''Convert _sane's string exceptions into proper ones.
+    String exceptions can't be reraised because they're illegal in modern
+    Python.'''
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type == _sane.error:
+            raise ScanError(exc_val)
+# pylint: enable=C0103
+
+
+class DynamicLengthSaneDev(sane.SaneDev):
+    '''If dynamic scan length is enabled in the driver, libsane reports an
+    image height of -1, which causes snap() to choke.  Report an appropriate
+    height, then slice off the unused bottom of the image.'''
+
+    # Rows examined per step when looking for the bottom of the page
+    TRIM_BAND = 64
+
+    # Longest page we are prepared to receive, in inches
+    max_length = 20
+
+    def get_parameters(self):
+        fmt, last_frame, (x, y), depth, bytes_per_line = \
+                sane.SaneDev.get_parameters(self)
+        if y == -1:
+            y = int(self.max_length * self.resolution)
+        return fmt, last_frame, (x, y), depth, bytes_per_line
+
+    def snap(self, no_cancel=False):
+        return trim_image(sane.SaneDev.snap(self, no_cancel), self.TRIM_BAND)
+
+
+_init_lock = threading.Lock()
+_initialized = False
+
+class SaneSource(ScanSource):
+    '''A scanner driven through SANE.'''
+
+    def __init__(self, config, device):
+        ScanSource.__init__(self, config, device)
+        try:
+            with sanitize():
+                self.dev = DynamicLengthSaneDev(device.device)
+        except RuntimeError, e:
+            # Attempted to open an invalid device
+            raise ScanError(str(e))
+        self.dev.max_length = config.max_page_length
+        self.set_options(device.device_config.iteritems())
+
+    @classmethod
+    def init(cls):
+        '''Initialize SANE once, however many scanner threads there are.'''
+        # pylint: disable=W0603
+        global _initialized
+        with _init_lock:
+            if not _initialized:
+                with sanitize():
+                    sane.init()
+                _initialized = True
+
+    def _set_option(self, name, value):
+        # SaneDev keeps its option descriptors in a dict which it replaces
+        # when setting an option causes the driver to change others
+        attrs = self.dev.__dict__
+        descriptors = attrs['opt']
+        with sanitize():
+            setattr(self.dev, name, value)
+        return attrs['opt'] is not descriptors
+
+    @property
+    def scan_button(self):
+        # The scan button is accessed via a SANE read-only setting called
+        # "scan", which conflicts with the SaneDev.scan() method, so we have
+        # to go the long way around.
+        try:
+            with sanitize():
+                index = self.dev['scan'].index
+                return bool(self.dev.__dict__['dev'].get_option(index))
+        except KeyError:
+            return False
+
+    def scan_pages(self):
+        '''Reimplementation of sane._SaneIterator which doesn't choke on
+        _sane exceptions.'''
+        try:
+            with sanitize():
+                while True:
+                    self.dev.start()
+                    yield self.dev.snap(True)
+        finally:
+            self.dev.cancel()
+
+    def close(self):
+        with sanitize():
+            self.dev.cancel()
+            self.dev.close()
@@ -18,47 +18,440 @@
 #
 
 from __future__ import division
+from collections import deque
+import errno
+import heapq
+from itertools import count, izip
+import multiprocessing
 import os
-from reportlab.pdfgen.canvas import Canvas
-from reportlab.lib.utils import ImageReader
 import threading
+import time
+
+from .page import encode_image
+
+_pool = None
+_pool_size = None
+_pool_lock = threading.Lock()
+
+def init_encoders(config):
+    '''Start the pool of page encoder processes.  Call this before starting
+    any threads, since the pool is created by forking.'''
+    # pylint: disable=W0603
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None:
+            _pool_size = (config.save_processes or
+                    multiprocessing.cpu_count())
+            _pool = multiprocessing.Pool(_pool_size)
+        return _pool
+
+
+def _pdf_number(value):
+    return ('%.4f' % value).rstrip('0').rstrip('.')
+
+
+def _pdf_string(value):
+    for c in '\\()':
+        value = value.replace(c, '\\' + c)
+    return '(%s)' % value
+
+
+class _PDFWriter(object):
+    '''Minimal PDF writer which embeds compressed image data (JPEG or
+    zlib) directly as image XObjects, without decoding, re-encoding, or
+    copying it.'''
+
+    # mode -> (color space, bits per component)
+    _COLORSPACES = {
+        '1': ('/DeviceGray', 1),
+        'L': ('/DeviceGray', 8),
+        'RGB': ('/DeviceRGB', 8),
+    }
+
+    def __init__(self, fh, title, creator, state=None):
+        '''If state is a value previously returned by get_state(), continue
+        writing the document from that point.'''
+        self._fh = fh
+        self._title = title
+        self._creator = creator
+        if state is not None:
+            position, self._offsets, self._next_id, self._page_ids = state
+            self._offsets = dict(self._offsets)
+            self._page_ids = list(self._page_ids)
+            self._catalog_id, self._pages_id, self._info_id = 1, 2, 3
+            # Discard anything written after the state was saved
+            fh.seek(position)
+            fh.truncate()
+            return
+        self._offsets = {}
+        self._next_id = 1
+        self._catalog_id = self._alloc()
+        self._pages_id = self._alloc()
+        self._info_id = self._alloc()
+        self._page_ids = []
+        # Binary comment marks the file as containing binary data
+        fh.write('%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def get_state(self):
+        '''Return a snapshot of the writer, from which writing can be
+        resumed on the same file.'''
+        return (self._fh.tell(), dict(self._offsets), self._next_id,
+                list(self._page_ids))
+
+    def _alloc(self):
+        id = self._next_id
+        self._next_id += 1
+        return id
+
+    def _begin_object(self, id):
+        self._offsets[id] = self._fh.tell()
+        self._fh.write('%d 0 obj\n' % id)
+
+    def _write_object(self, id, body):
+        self._begin_object(id)
+        self._fh.write(body)
+        self._fh.write('\nendobj\n')
+
+    def _write_stream(self, id, attrs, data):
+        self._begin_object(id)
+        attrs = ' '.join(a for a in (attrs, '/Length %d' % len(data)) if a)
+        self._fh.write('<< %s >>\nstream\n' % attrs)
+        self._fh.write(data)
+        self._fh.write('\nendstream\nendobj\n')
+
+    def add_page(self, filter, mode, data, pixel_size, page_size,
+            rotation=0):
+        '''filter is the PDF filter for the image data.  page_size is in
+        points, and both sizes are before rotation.  rotation is in degrees
+        counterclockwise, and is applied by the viewer rather than to the
+        image data.'''
+        try:
+            colorspace, bits = self._COLORSPACES[mode]
+        except KeyError:
+            raise ValueError('Unsupported image mode %s' % mode)
+        image_id = self._alloc()
+        content_id = self._alloc()
+        page_id = self._alloc()
+        w, h = [_pdf_number(a) for a in page_size]
+
+        self._write_stream(image_id, '/Type /XObject /Subtype /Image '
+                '/Width %d /Height %d /ColorSpace %s /BitsPerComponent %d '
+                '/Filter /%s' % (pixel_size[0], pixel_size[1], colorspace,
+                bits, filter), data)
+        self._write_stream(content_id, '',
+                'q %s 0 0 %s 0 0 cm /Im0 Do Q' % (w, h))
+        self._write_object(page_id, '<< /Type /Page /Parent %d 0 R '
+                '/MediaBox [0 0 %s %s] /Rotate %d /Contents %d 0 R '
+                '/Resources << /XObject << /Im0 %d 0 R >> '
+                '/ProcSet [/PDF /ImageB /ImageC] >> >>' %
+                (self._pages_id, w, h, -rotation % 360, content_id,
+                image_id))
+        self._page_ids.append(page_id)
+
+    def close(self):
+        '''Write the document trailer.  Does not close the file.'''
+        self._write_object(self._pages_id, '<< /Type /Pages /Kids [%s] '
+                '/Count %d >>' % (' '.join('%d 0 R' % id
+                for id in self._page_ids), len(self._page_ids)))
+        self._write_object(self._catalog_id, '<< /Type /Catalog '
+                '/Pages %d 0 R >>' % self._pages_id)
+        self._write_object(self._info_id, '<< /Title %s /Creator %s '
+                '/Producer %s >>' % (_pdf_string(self._title),
+                _pdf_string(self._creator), _pdf_string(self._creator)))
+
+        xref = self._fh.tell()
+        self._fh.write('xref\n0 %d\n' % self._next_id)
+        self._fh.write('0000000000 65535 f \n')
+        for id in range(1, self._next_id):
+            self._fh.write('%010d 00000 n \n' % self._offsets[id])
+        self._fh.write('trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\n'
+                'startxref\n%d\n%%%%EOF\n' % (self._next_id,
+                self._catalog_id, self._info_id, xref))
+
+
+class _Encoded(object):
+    '''Stand-in for an AsyncResult for a page that was already encoded.'''
+
+    def __init__(self, data):
+        self._data = data
+
+    def get(self, _timeout=None):
+        return self._data
+
+
+class _Cancelled(Exception):
+    pass
+
 
 class SaveThread(threading.Thread):
+    # Seconds between checks for cancellation while waiting for an encoder
+    POLL_INTERVAL = 1
+    # Seconds to wait for a page to be encoded before assuming the worker
+    # process handling it has died
+    ENCODE_TIMEOUT = 300
+
     def __init__(self, config, filename, pages, progress_callback,
             success_callback, error_callback):
         threading.Thread.__init__(self, name='save')
         self.filename = filename
         self.pages = pages
+        self.priority = 0
         self._config = config
         self._progress_callback = progress_callback
         self._success_callback = success_callback
         self._error_callback = error_callback
+        self._cancel = threading.Event()
+        self._throttle = threading.Event()
+        # Error message if the save failed
+        self.error = None
+        # (pages written, writer state) as of the last page that was
+        # safely written to disk
+        self.checkpoint = None
+        # Partial output file created by this job (or the one it
+        # resumes), which nobody else may touch
+        self._partial = None
+
+    @property
+    def started(self):
+        return self.ident is not None
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        '''Stop the save.  The error callback will be called.'''
+        self._cancel.set()
+
+    def set_throttled(self, throttled):
+        '''While throttled, only encode one page at a time.'''
+        if throttled:
+            self._throttle.set()
+        else:
+            self._throttle.clear()
+
+    def retry(self):
+        '''Return a new SaveThread which resumes this failed one from its
+        last checkpoint.'''
+        thread = SaveThread(self._config, self.filename, self.pages,
+                self._progress_callback, self._success_callback,
+                self._error_callback)
+        thread.priority = self.priority
+        if self._partial is not None:
+            thread._partial = self._partial
+            thread.checkpoint = self.checkpoint
+        return thread
+
+    def discard(self):
+        '''Delete the partial output of a failed save.'''
+        if self._partial is None:
+            return
+        try:
+            os.unlink(self._partial)
+        except OSError:
+            pass
+        self._partial = None
+
+    def _create_partial(self):
+        '''Create the partial output file, failing if another save to the
+        same name has already created it.'''
+        path = self.filename + '.pdf.part'
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                raise Exception('Another save to this file is in progress, '
+                        'or %s was left behind by one' % path)
+            raise
+        self._partial = path
+        return os.fdopen(fd, 'wb')
+
+    def _encode_pages(self, pages):
+        '''Encode pages in the worker processes and yield the results in
+        page order, keeping a bounded number of pages in flight.'''
+        pool = init_encoders(self._config)
+        pending = deque()
+        pages = iter(pages)
+        while True:
+            if self._cancel.is_set():
+                raise _Cancelled('Cancelled')
+            window = 1 if self._throttle.is_set() else 2 * _pool_size
+            while len(pending) < window:
+                try:
+                    page = pages.next()
+                except StopIteration:
+                    break
+                encoded = page.cached_encoding
+                if encoded is not None:
+                    pending.append(_Encoded(encoded))
+                else:
+                    pending.append(pool.apply_async(encode_image,
+                            (page.stored_image.path,
+                            self._config.jpeg_quality,
+                            self._config.adaptive_compression)))
+            if not pending:
+                return
+            yield self._wait(pending.popleft())
+
+    def _wait(self, result):
+        '''Return the value of an encoder result, giving up if the job is
+        cancelled or the result never arrives.'''
+        deadline = time.time() + self.ENCODE_TIMEOUT
+        while True:
+            if self._cancel.is_set():
+                raise _Cancelled('Cancelled')
+            try:
+                return result.get(self.POLL_INTERVAL)
+            except multiprocessing.TimeoutError:
+                if time.time() >= deadline:
+                    raise Exception('Timed out waiting for a page to be '
+                            'encoded')
+
+    @staticmethod
+    def _sync(fh):
+        fh.flush()
+        os.fsync(fh.fileno())
+
+    def _publish(self, filename):
+        '''Atomically move the finished document into place, without
+        replacing an existing file.'''
+        partial = self._partial
+        try:
+            os.link(partial, filename)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                raise Exception('File already exists')
+            # Filesystem doesn't support hard links
+            if os.path.exists(filename):
+                raise Exception('File already exists')
+            os.rename(partial, filename)
+        else:
+            os.unlink(partial)
+        self._partial = None
 
     # We intentionally catch all exceptions
     # pylint: disable=W0703
     def run(self):
+        # Keep the page images alive while the encoder processes use them
+        images = [page.stored_image for page in self.pages]
+        for image in images:
+            image.ref()
         try:
             filename = self.filename + '.pdf'
             if os.path.exists(filename):
                 raise Exception('File already exists')
-            canvas = Canvas(filename, pageCompression=1)
-            canvas.setCreator('Scanvark')
-            canvas.setTitle('Scanned document')
-            i = 0
-            count = len(self.pages)
-            for i, page in enumerate(self.pages):
-                self._progress_callback(self, i, count)
-                w, h = [a * 72 / page.resolution for a in page.size]
-                canvas.setPageSize((w, h))
-                reader = ImageReader(page.open_jpeg())
-                canvas.drawImage(reader, 0, 0, width=w, height=h)
-                canvas.showPage()
-            self._progress_callback(self, i, count)
-            canvas.save()
+            if self.checkpoint is not None and self._partial is not None:
+                done, state = self.checkpoint
+                fh = open(self._partial, 'r+b')
+            else:
+                done, state = 0, None
+                self.discard()
+                fh = self._create_partial()
+            with fh:
+                writer = _PDFWriter(fh, 'Scanned document', 'Scanvark',
+                        state)
+                count = len(self.pages)
+                self._progress_callback(self, done, count)
+                remaining = self.pages[done:]
+                for i, (page, (filter, mode, data)) in enumerate(izip(
+                        remaining, self._encode_pages(remaining)), done):
+                    size = page.image_size
+                    writer.add_page(filter, mode, data, size,
+                            [a * 72 / page.resolution for a in size],
+                            page.rotation)
+                    # Make sure the page is on disk before recording that
+                    # we can resume after it
+                    self._sync(fh)
+                    self.checkpoint = (i + 1, writer.get_state())
+                    self._progress_callback(self, i + 1, count)
+                writer.close()
+                self._sync(fh)
+            self._publish(filename)
         except Exception, e:
+            if self.cancelled:
+                self.discard()
+            else:
+                self.error = str(e)
             self._error_callback(self, str(e))
         else:
             for page in self.pages:
                 page.finish()
             self._success_callback(self)
+        finally:
+            for image in images:
+                image.unref()
     # pylint: enable=W0703
+
+
+class SaveScheduler(object):
+    '''Run SaveThreads in a limited number of slots, queueing the rest by
+    priority and then by submission order.  While a scan is running, fewer
+    jobs run at once and each one encodes fewer pages in parallel, so that
+    the scanner isn't starved.'''
+
+    def __init__(self, config):
+        self._slots = max(config.save_jobs, 1)
+        self._scan_slots = max(config.save_jobs_while_scanning, 0)
+        self._lock = threading.Lock()
+        # Heap of (-priority, sequence, thread)
+        self._queue = []
+        self._sequence = count()
+        self._running = set()
+        self._scanning = False
+
+    def submit(self, thread, priority=0):
+        with self._lock:
+            thread.priority = priority
+            heapq.heappush(self._queue, (-priority, self._sequence.next(),
+                    thread))
+            self._start_jobs()
+
+    def prioritize(self, thread):
+        '''Move a queued job to the front of the queue.'''
+        with self._lock:
+            if self._remove(thread):
+                priority = max([thread.priority] +
+                        [-p for p, _seq, _thread in self._queue]) + 1
+                thread.priority = priority
+                heapq.heappush(self._queue, (-priority,
+                        self._sequence.next(), thread))
+                self._start_jobs()
+
+    def cancel(self, thread):
+        '''Cancel a job.  Return True if it was still queued and has been
+        dropped; otherwise the running job will stop and call its error
+        callback.'''
+        with self._lock:
+            if self._remove(thread):
+                return True
+        thread.cancel()
+        return False
+
+    def finished(self, thread):
+        '''Notify the scheduler that a job has completed.'''
+        with self._lock:
+            self._running.discard(thread)
+            self._start_jobs()
+
+    def set_scanning(self, scanning):
+        with self._lock:
+            self._scanning = scanning
+            for thread in self._running:
+                thread.set_throttled(scanning)
+            self._start_jobs()
+
+    def _remove(self, thread):
+        for i, (_priority, _seq, queued) in enumerate(self._queue):
+            if queued is thread:
+                del self._queue[i]
+                heapq.heapify(self._queue)
+                return True
+        return False
+
+    def _start_jobs(self):
+        limit = self._scan_slots if self._scanning else self._slots
+        while self._queue and len(self._running) < limit:
+            _priority, _seq, thread = heapq.heappop(self._queue)
+            self._running.add(thread)
+            thread.set_throttled(self._scanning)
+            thread.start()
@@ -18,67 +18,154 @@
 #
 
 from __future__ import division
+import logging
 import numpy
 from PIL import Image
-import sane
-import _sane
+import Queue
+import sys
 import threading
 import time
 
+from .button import get_notifier_class
 from .page import Page
+from .source import FEEDER_EMPTY, ScanError, get_source_class
 
-class ScanError(Exception):
-    # Class named according to method naming conventions.
-    # pylint: disable=C0103
-    class sanitize(object):
-        '''Convert _sane's string exceptions into proper ones.
-        String exceptions can't be reraised because they're illegal in modern
-        Python.'''
+_log = logging.getLogger(__name__)
 
-        def __enter__(self):
-            pass
+# Resolution at which pages are examined for blankness
+_BLANK_SAMPLE_DPI = 75
+# Amount by which a pixel must be darker than the paper to count as ink
+_BLANK_INK_CONTRAST = 64
+# Percentile of pixel brightness taken as the paper level.  It must be
+# high, since the paper may cover only a small part of a dark page.
+_BLANK_PAPER_PERCENTILE = 95
+# Pages whose paper level is darker than this are never blank
+_BLANK_MIN_PAPER = 128
+
+def is_blank(image, resolution, threshold, margin):
+    '''Return True if less than threshold of the image, excluding a border
+    margin inches wide, is noticeably darker than the paper.'''
+    # Sample a low-resolution grid; ink coverage is a statistical measure,
+    # so there's no need to look at every pixel
+    step = max(int(resolution // _BLANK_SAMPLE_DPI), 1)
+    width, height = image.size
+    sample = image.resize((max(width // step, 1), max(height // step, 1)),
+            Image.NEAREST)
+    # arr[y][x] or arr[y][x][channel]
+    arr = numpy.asarray(sample)
+    if arr.ndim == 3:
+        # Colored ink is dark in at least one channel
+        arr = arr.min(2)
+    border = int(margin * resolution / step)
+    if border:
+        arr = arr[border:-border, border:-border]
+    if not arr.size:
+        return True
+    # Measure against the paper rather than against white, so that tinted
+    # stock and faint show-through from the other side are ignored
+    paper = numpy.percentile(arr, _BLANK_PAPER_PERCENTILE)
+    if paper < _BLANK_MIN_PAPER:
+        # Mostly dark, e.g. a photo or a solid cover, not blank paper
+        return False
+    ink = numpy.count_nonzero(arr < paper - _BLANK_INK_CONTRAST)
+    return ink < threshold * arr.size
+
+
+class _PageBuilder(object):
+    '''Construct Pages from scanned images on a pool of worker threads, so
+    that the scanner can feed the next sheet while the previous one is
+    still being encoded.  Pages are delivered in the order they were
+    submitted.'''
+
+    def __init__(self, config, store, source, page_callback):
+        self._config = config
+        self._store = store
+        self._source = source
+        self._page_callback = page_callback
+        # Bound the number of full-size images waiting for a worker
+        self._queue = Queue.Queue(config.page_queue_size)
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._delivered = 0
+        self._finished = {}
+        self._error = None
+        for i in range(max(config.page_workers, 1)):
+            thread = threading.Thread(target=self._worker,
+                    name='page-builder-%d' % i)
+            thread.daemon = True
+            thread.start()
 
-        def __exit__(self, exc_type, exc_val, exc_tb):
-            if exc_type == _sane.error:
-                raise ScanError(exc_val)
-    # pylint: enable=C0103
-
-
-class DynamicLengthSaneDev(sane.SaneDev):
-    '''If dynamic scan length is enabled in the driver, libsane reports an
-    image height of -1, which causes snap() to choke.  Report an appropriate
-    height, then slice off the unused bottom of the image.'''
-
-    def get_parameters(self):
-        fmt, last_frame, (x, y), depth, bytes_per_line = \
-                sane.SaneDev.get_parameters(self)
-        if y == -1:
-            y = 20 * self.resolution
-        return fmt, last_frame, (x, y), depth, bytes_per_line
-
-    def snap(self, no_cancel=False):
-        img = sane.SaneDev.snap(self, no_cancel)
-        # arr[y][x][channel]
-        arr = numpy.asarray(img)
-        # Look for rows in X that are entirely black.
-        condition = arr.any(1)
-        if len(condition.shape) > 1:
-            # Look for rows in channel that are entirely black.
-            condition = condition.any(1)
-        # Select only nonblank rows.
-        return Image.fromarray(arr.compress(condition, 0))
+    def submit(self, image, resolution, rotation):
+        # Blocks if the workers have fallen too far behind
+        self._queue.put((self._submitted, image, resolution, rotation))
+        self._submitted += 1
+
+    def flush(self):
+        '''Wait for all submitted pages to be delivered, then raise the
+        first error encountered while building them, if any.'''
+        self._queue.join()
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    # We intentionally catch all exceptions
+    # pylint: disable=W0703
+    def _worker(self):
+        while True:
+            seq, image, resolution, rotation = self._queue.get()
+            try:
+                mode = self._config.blank_pages
+                blank = mode != 'keep' and is_blank(image, resolution,
+                        self._config.blank_threshold,
+                        self._config.blank_margin)
+                if blank and mode == 'drop':
+                    page = None
+                else:
+                    page = Page(self._config, self._store, image,
+                            resolution, rotation, source=self._source,
+                            blank=blank)
+            except Exception, e:
+                page = None
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+            del image
+            with self._lock:
+                self._finished[seq] = page
+                while self._delivered in self._finished:
+                    page = self._finished.pop(self._delivered)
+                    if page is not None:
+                        self._page_callback(page)
+                    self._delivered += 1
+            self._queue.task_done()
+    # pylint: enable=W0703
 
 
 class ScannerThread(threading.Thread):
-    def __init__(self, config, scan_status_callback, page_callback,
-            error_callback):
-        threading.Thread.__init__(self, name='scanner')
+    # Bounds on the interval between attempts to reconnect to the
+    # scanner, in seconds
+    RECONNECT_MIN = 1
+    RECONNECT_MAX = 60
+
+    def __init__(self, config, device, store, scan_status_callback,
+            page_callback, error_callback):
+        threading.Thread.__init__(self, name='scanner-%s' % device.name)
         self.daemon = True
         self._config = config
+        self.device = device
+        self._store = store
         self._scan_status_callback = scan_status_callback
         self._page_callback = page_callback
         self._error_callback = error_callback
-        self._dev = None
+        self._source_class = get_source_class(device.backend)
+        self._session = None
+        self._button = get_notifier_class(device.button)(config, device)
+        self._reconnect_delay = self.RECONNECT_MIN
+        self._reconnect_time = 0
+        # Scan settings last sent to the scanner while idle
+        self._idle_settings = None
+        self._builder = None
         self._start = threading.Event()
         self._stopping = threading.Event()
         self.resolution = None
@@ -88,14 +175,17 @@ class ScannerThread(threading.Thread):
     # We intentionally catch all exceptions
     # pylint: disable=W0703
     def run(self):
-        # Initialize SANE
+        # Initialize the scanner backend
         try:
-            with ScanError.sanitize():
-                sane.init()
+            self._source_class.init()
         except Exception, e:
-            self._error_callback("Couldn't initialize SANE: %s" % e)
+            self._error_callback("Couldn't initialize %s backend: %s" %
+                    (self.device.backend, e))
             return
 
+        self._builder = _PageBuilder(self._config, self._store,
+                self.device.name, self._page_callback)
+
         # Try to initialize the scanner so that the hardware scan button
         # will work.
         try:
@@ -109,61 +199,74 @@ class ScannerThread(threading.Thread):
                 if self._stopping.is_set():
                     break
                 self._scan_status_callback(True)
-                # Wait for the scan status callback to run in the UI thread
-                # before _setup() takes the GIL for perhaps 1 second
-                time.sleep(0.1)
-                self._setup()
+                if self._session is None:
+                    # Wait for the scan status callback to run in the UI
+                    # thread before _setup() takes the GIL for perhaps 1
+                    # second
+                    time.sleep(0.1)
+                    self._setup()
                 self._run_scan()
             except Exception, e:
                 self._error_callback("Scan failed: %s" % e)
                 self._close()
             finally:
+                self._button.activity()
                 self._scan_status_callback(False)
 
         self._close()
     # pylint: enable=W0703
 
     def _setup(self):
-        if self._dev is None:
+        if self._session is None:
             try:
-                with ScanError.sanitize():
-                    dev = DynamicLengthSaneDev(self._config.device)
-                    for k, v in self._config.device_config.iteritems():
-                        setattr(dev, k, v)
-            except RuntimeError, e:
-                # Attempted to open an invalid device
-                raise ScanError(str(e))
-            self._dev = dev
+                self._session = self._source_class(self._config,
+                        self.device)
+            except Exception:
+                # Back off before trying again in the background
+                self._reconnect_time = time.time() + self._reconnect_delay
+                self._reconnect_delay = min(self._reconnect_delay * 2,
+                        self.RECONNECT_MAX)
+                raise
+            self._reconnect_delay = self.RECONNECT_MIN
 
     def _close(self):
-        if self._dev is not None:
+        if self._session is not None:
             try:
-                with ScanError.sanitize():
-                    self._dev.cancel()
-                    self._dev.close()
-                self._dev = None
+                self._session.close()
             except ScanError:
                 pass
+            self._session = None
+            self._idle_settings = None
+        # Don't reopen the scanner right away in the background
+        self._reconnect_time = time.time() + self._reconnect_delay
 
     def _wait_for_start(self):
         '''Wait for a software start event or hardware button press.'''
         while not self._stopping.is_set():
-            if self._dev is not None:
-                # Have a scanner connection.  First check hardware button.
+            if self._session is not None:
+                # Have a scanner connection.  Wait for the hardware
+                # button or a software start.
                 try:
-                    if self._scan_button:
+                    self._apply_idle_settings()
+                    if self._button.wait(self._session, self._start):
                         break
                 except ScanError:
                     # Scanner went away
                     self._close()
-
-                # Block on software start.
-                if self._start.wait(0.1):
+                if self._start.is_set():
                     break
 
             else:
-                # No scanner connection.  Don't try to make one, because
-                # _setup() can take a while and runs with the GIL held.
+                # No scanner connection.  Reconnect in the background, so
+                # that the next scan can start right away, but not too
+                # often, because _setup() can take a while and runs with
+                # the GIL held.
+                if time.time() >= self._reconnect_time:
+                    try:
+                        self._setup()
+                        continue
+                    except Exception:
+                        pass
                 # Block on software start.
                 if self._start.wait(1):
                     break
@@ -171,42 +274,73 @@ class ScannerThread(threading.Thread):
         # Reset start event
         self._start.clear()
 
+    def _scan_options(self):
+        if self.double_sided:
+            source = self.device.source_double
+        else:
+            source = self.device.source_single
+        return [
+            ('resolution', self.resolution),
+            ('mode', 'color' if self.color else 'gray'),
+            ('source', source),
+        ]
+
+    # We intentionally catch all exceptions
+    # pylint: disable=W0703
+    def _apply_idle_settings(self):
+        '''Send changed scan settings to the scanner ahead of time, so
+        that the next scan doesn't have to wait for them.  Failures are
+        not fatal: the scan sends the settings again and reports any
+        error.'''
+        settings = (self.resolution, self.color, self.double_sided)
+        if self.resolution is None or settings == self._idle_settings:
+            return
+        self._idle_settings = settings
+        try:
+            self._session.set_options(self._scan_options())
+        except Exception, e:
+            _log.warning("Couldn't apply scan settings to %s: %s",
+                    self.device.name, e)
+    # pylint: enable=W0703
+
     def _run_scan(self):
-        # pylint chokes on SaneDev's dynamic attributes
-        # pylint: disable=W0201
-        with ScanError.sanitize():
-            self._dev.resolution = self.resolution
-            if self.color:
-                self._dev.mode = 'color'
-            else:
-                self._dev.mode = 'gray'
-            if self.double_sided:
-                self._dev.source = self._config.source_double
-            else:
-                self._dev.source = self._config.source_single
-        # pylint: enable=W0201
+        # Only sends options which have changed since the last scan
+        self._session.set_options(self._scan_options())
 
+        # Don't report the scan finished until all of its pages have
+        # reached the page list
         odd = True
-        for img in self._scan_pages():
-            page = Page(self._config, img, self.resolution,
-                    self._config.rotate_odd if odd else
-                    self._config.rotate_even)
-            self._page_callback(page)
-            odd = not odd
-
-    def _scan_pages(self):
-        '''Reimplementation of sane._SaneIterator which doesn't choke on
-        _sane exceptions.'''
         try:
-            with ScanError.sanitize():
-                while True:
-                    self._dev.start()
-                    yield self._dev.snap(True)
-        except ScanError, e:
-            if str(e) != 'Document feeder out of documents':
-                raise
-        finally:
-            self._dev.cancel()
+            try:
+                for img in self._session.scan_pages():
+                    self._builder.submit(img, self.resolution,
+                            self.device.rotate_odd if odd else
+                            self.device.rotate_even)
+                    odd = not odd
+            except ScanError, e:
+                if str(e) != FEEDER_EMPTY:
+                    raise
+        # Flush on any error, then reraise it
+        # pylint: disable=W0702
+        except:
+            exc_info = sys.exc_info()
+            self._flush_quietly()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        # pylint: enable=W0702
+        self._builder.flush()
+
+    # We intentionally catch all exceptions
+    # pylint: disable=W0703
+    def _flush_quietly(self):
+        '''Deliver the pages scanned before a scan error, logging rather
+        than raising any page-building error so it doesn't hide the scan
+        error.'''
+        try:
+            self._builder.flush()
+        except Exception, e:
+            _log.warning("Couldn't build page from %s: %s",
+                    self.device.name, e)
+    # pylint: enable=W0703
 
     def scan(self):
         # Runs in UI thread
@@ -218,13 +352,5 @@ class ScannerThread(threading.Thread):
         self._start.set()
 
     @property
-    def _scan_button(self):
-        # The scan button is accessed via a SANE read-only setting called
-        # "scan", which conflicts with the SaneDev.scan() method, so we have
-        # to go the long way around.
-        try:
-            with ScanError.sanitize():
-                index = self._dev['scan'].index
-                return bool(self._dev.__dict__['dev'].get_option(index))
-        except KeyError:
-            return False
+    def button_stats(self):
+        return self._button.stats
@@ -0,0 +1,119 @@
+#
+# Scanvark -- a Gtk-based batch scanning program
+#
+# Copyright (c) 2012 Benjamin Gilbert
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import division
+import numpy
+from PIL import Image
+import random
+import time
+
+from .source import FEEDER_EMPTY, ScanError, ScanSource, trim_image
+
+class SimulatedSource(ScanSource):
+    '''A synthetic scanner with a document feeder, for exercising the scan
+    pipeline without hardware.  Each scan feeds a stack of sheets,
+    producing pages of lines of fake text.  Configured by the device's
+    simulation settings:
+
+        width, length: page size in inches (8.5 x 11)
+        sheets: sheets fed per scan (10)
+        feed-rate: sheets per minute, or 0 for as fast as possible (20)
+        error-rate: probability that a sheet jams (0)
+        blank-rate: probability that a page is blank (0)
+        dynamic-length: deliver pages in a max-page-length buffer and trim
+            them, as a dynamic-length scanner would (false)
+        seed: random seed
+
+    Resolution, mode, and source are set by the scan settings; the source
+    is duplex if it matches the device's double-source.'''
+
+    # Rows of text per inch
+    LINES_PER_INCH = 6
+    MARGIN = 1
+
+    def __init__(self, config, device):
+        ScanSource.__init__(self, config, device)
+        sim = device.simulation
+        self._width = sim.get('width', 8.5)
+        self._length = sim.get('length', 11)
+        self._sheets = sim.get('sheets', 10)
+        self._feed_rate = sim.get('feed-rate', 20)
+        self._error_rate = sim.get('error-rate', 0)
+        self._blank_rate = sim.get('blank-rate', 0)
+        self._dynamic_length = sim.get('dynamic-length', False)
+        self._random = random.Random(sim.get('seed', None))
+        self._settings = {
+            'resolution': 150,
+            'mode': 'color',
+            'source': device.source_single,
+        }
+        self.set_options(device.device_config.iteritems())
+
+    def _set_option(self, name, value):
+        self._settings[name] = value
+        return False
+
+    def scan_pages(self):
+        duplex = (self._settings['source'] == self.device.source_double
+                and self.device.source_double is not None)
+        interval = 60 / self._feed_rate if self._feed_rate else 0
+        next_sheet = time.time()
+        for _sheet in range(self._sheets):
+            delay = next_sheet - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_sheet += interval
+            if self._random.random() < self._error_rate:
+                raise ScanError('Document feeder jammed')
+            for _side in range(2 if duplex else 1):
+                yield self.make_page()
+        raise ScanError(FEEDER_EMPTY)
+
+    def make_page(self):
+        '''Return a synthetic scanned page.'''
+        resolution = self._settings['resolution']
+        width = int(self._width * resolution)
+        height = int(self._length * resolution)
+        if self._dynamic_length:
+            buffer_height = max(int(self._config.max_page_length *
+                    resolution), height)
+        else:
+            buffer_height = height
+        color = self._settings['mode'] == 'color'
+        # arr[y][x][channel]; the unused part of a dynamic-length buffer
+        # is black
+        arr = numpy.zeros((buffer_height, width, 3 if color else 1),
+                dtype=numpy.uint8)
+        # Slightly off-white paper
+        arr[:height] = 245
+        if self._random.random() >= self._blank_rate:
+            margin = int(self.MARGIN * resolution)
+            pitch = max(resolution // self.LINES_PER_INCH, 2)
+            for top in range(margin, height - margin - pitch, pitch):
+                right = self._random.randint(margin, width - margin)
+                ink = [self._random.randint(0, 80) for _i in
+                        range(arr.shape[2])]
+                arr[top:top + pitch // 2, margin:right] = ink
+        if color:
+            img = Image.fromarray(arr, 'RGB')
+        else:
+            img = Image.fromarray(arr[:, :, 0], 'L')
+        if self._dynamic_length:
+            img = trim_image(img)
+        return img
@@ -0,0 +1,124 @@
+#
+# Scanvark -- a Gtk-based batch scanning program
+#
+# Copyright (c) 2012 Benjamin Gilbert
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import division
+import importlib
+import numpy
+
+# Error reported when the document feeder runs out of paper, which ends
+# a scan normally
+FEEDER_EMPTY = 'Document feeder out of documents'
+
+# Backend name -> (module, class)
+_backends = {
+    'sane': ('.sanedev', 'SaneSource'),
+    'simulated': ('.simulated', 'SimulatedSource'),
+}
+
+class ScanError(Exception):
+    pass
+
+
+def get_source_class(backend):
+    '''Return the ScanSource subclass for the named backend.  Backend
+    modules are only imported when needed, so that, for example, the SANE
+    bindings need not be installed to use the simulated scanner.'''
+    try:
+        module_name, class_name = _backends[backend]
+    except KeyError:
+        raise ValueError('Unknown scanner backend: %s' % backend)
+    module = importlib.import_module(module_name,
+            __name__.rpartition('.')[0])
+    return getattr(module, class_name)
+
+
+class ScanSource(object):
+    '''An open connection to a scanner, and the options we have set on it.
+    Options are only sent to the scanner when their values change.'''
+
+    def __init__(self, config, device):
+        self._config = config
+        self.device = device
+        # option name -> value last set
+        self._values = {}
+
+    @classmethod
+    def init(cls):
+        '''Initialize the backend.  Called by each scanner thread before
+        opening a source.'''
+        pass
+
+    def set_options(self, options):
+        '''Set options from a sequence of (name, value) pairs.'''
+        for name, value in options:
+            if name in self._values and self._values[name] == value:
+                continue
+            if self._set_option(name, value):
+                # Other options may have changed
+                self._values.clear()
+            self._values[name] = value
+
+    def _set_option(self, name, value):
+        '''Send an option to the scanner.  Return True if this may have
+        changed the values of other options.'''
+        raise NotImplementedError()
+
+    @property
+    def scan_button(self):
+        '''True if the hardware scan button is pressed.'''
+        return False
+
+    def scan_pages(self):
+        '''Yield scanned images until the feeder is empty, at which point
+        raise ScanError(FEEDER_EMPTY).'''
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+# Largest band examined at once by trim_image()
+_TRIM_MAX_BAND = 1024
+
+def trim_image(img, band=64):
+    '''Slice the all-black rows off the bottom of img.  Walk up from the
+    bottom of the buffer looking for the last row that isn't entirely
+    black, starting with a band of the given height and doubling it at
+    each step, so that only the unused tail of the buffer and one band of
+    the page are examined.'''
+    width, height = img.size
+    bottom = height
+    while bottom > 0:
+        top = max(bottom - band, 0)
+        # arr[y][x * channels]
+        arr = numpy.asarray(img.crop((0, top, width, bottom)))
+        rows = arr.reshape(bottom - top, -1).any(1)
+        if rows.any():
+            # Number of black rows below the last nonblank one
+            bottom -= rows[::-1].argmax()
+            break
+        bottom = top
+        band = min(band * 2, _TRIM_MAX_BAND)
+    if bottom == height:
+        # Nothing to trim
+        return img
+    page = img.crop((0, 0, width, bottom))
+    # Make sure the page no longer refers to the full-length buffer
+    page.load()
+    return page
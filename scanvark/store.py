@@ -0,0 +1,161 @@
+#
+# Scanvark -- a Gtk-based batch scanning program
+#
+# Copyright (c) 2012 Benjamin Gilbert
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of version 2 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import division
+import mmap
+import numpy
+import os
+from PIL import Image
+import shutil
+from tempfile import mkdtemp
+import threading
+
+class StoredFile(object):
+    '''A file in the page store.  The file is deleted when the last
+    reference is dropped.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def ref(self):
+        with self._lock:
+            if self._refs == 0:
+                raise ValueError('Stored file has already been released')
+            self._refs += 1
+
+    def unref(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def read(self):
+        with open(self.path, 'rb') as fh:
+            return fh.read()
+
+
+class StoredImage(StoredFile):
+    '''An image in the page store.'''
+
+    _CHANNELS = {
+        'L': 1,
+        'RGB': 3,
+    }
+
+    def __init__(self, path, mode, size, mappable):
+        StoredFile.__init__(self, path)
+        self.mode = mode
+        self.size = size
+        # Whether the file ends with the uncompressed raster
+        self._mappable = mappable and mode in self._CHANNELS
+
+    @property
+    def mappable(self):
+        '''Whether get_array() is cheap, rather than decoding the file.'''
+        return self._mappable
+
+    def _map(self):
+        '''Return an mmap of the file and the offset of the raster within
+        it.  The mmap is unmapped when the last reference to it goes
+        away, so callers needn't hold a file descriptor.'''
+        with open(self.path, 'rb') as fh:
+            map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        w, h = self.size
+        # The raster follows a PNM header of unknown length
+        return map, len(map) - w * h * self._CHANNELS[self.mode]
+
+    def get_array(self):
+        '''Return a read-only array of the pixels, indexed as
+        arr[y][x][channel], or arr[y][x] for grayscale.  For uncompressed
+        images this is a view of the memory-mapped file, not a copy.'''
+        if not self._mappable:
+            return numpy.asarray(self.load())
+        map, offset = self._map()
+        w, h = self.size
+        arr = numpy.frombuffer(map, numpy.uint8, offset=offset)
+        if self.mode == 'L':
+            return arr.reshape(h, w)
+        else:
+            return arr.reshape(h, w, self._CHANNELS[self.mode])
+
+    def load(self):
+        if self._mappable and self.mode == 'L':
+            # PIL can share memory with the map for single-byte modes
+            map, offset = self._map()
+            return Image.frombuffer(self.mode, self.size, buffer(map, offset),
+                    'raw', self.mode, 0, 1)
+        image = Image.open(self.path)
+        image.load()
+        return image
+
+
+class PageStore(object):
+    '''Spool directory holding the images of all pages in the session, and
+    their pre-encoded forms.'''
+
+    _FORMATS = {
+        # compression -> (PIL format, file extension)
+        'none': ('ppm', 'pnm'),
+        'png': ('png', 'png'),
+    }
+
+    def __init__(self, config):
+        try:
+            self._format, self._extension = \
+                    self._FORMATS[config.store_compression]
+        except KeyError:
+            raise ValueError('Unknown page store compression: %s' %
+                    config.store_compression)
+        self._level = config.store_compression_level
+        self._dir = mkdtemp(prefix='scanvark-',
+                dir=config.store_directory)
+        self._lock = threading.Lock()
+        self._counter = 0
+
+    def _new_path(self, extension):
+        with self._lock:
+            self._counter += 1
+            return os.path.join(self._dir, '%d.%s' % (self._counter,
+                    extension))
+
+    def add(self, image):
+        path = self._new_path(self._extension)
+        if self._format == 'png':
+            image.save(path, 'png', compress_level=self._level)
+        else:
+            image.save(path, self._format)
+        return StoredImage(path, image.mode, image.size,
+                self._format == 'ppm')
+
+    def add_data(self, data, extension):
+        '''Spool a string, such as an encoded page, and return a
+        StoredFile for it.'''
+        path = self._new_path(extension)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return StoredFile(path)
+
+    def close(self):
+        shutil.rmtree(self._dir, ignore_errors=True)
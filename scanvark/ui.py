@@ -19,12 +19,22 @@
 
 from __future__ import division
 from bisect import bisect_left
-from collections import Sequence
+from collections import OrderedDict, Sequence
+from contextlib import contextmanager
 import glib
 import gobject
 import gtk
+import math
+import threading
+
+from .models import pixbuf_from_array
 
 _BASE_RESOLUTION = 600
+_THUMBNAIL_ZOOM = 1.25
+_MIN_THUMBNAIL_SIZE = 50
+_MAX_THUMBNAIL_SIZE = 1000
+# Thumbnails to load on either side of the visible ones
+_THUMBNAIL_PREFETCH = 50
 
 class _IconViewCoordinateList(Sequence):
     '''gtk.IconView provides no API to get an icon's row and column from
@@ -204,15 +214,70 @@ class _PageView(_ListIconView):
         'selection-activated': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
                 ()),
         'delete-selected': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+        'zoom': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                (gobject.TYPE_INT,)),
     }
 
-    def __init__(self, model):
+    def __init__(self, model, show_source=False):
         _ListIconView.__init__(self, model)
         self.set_pixbuf_column(model.PIXBUF_COLUMN)
+        if show_source:
+            # Label pages with the scanner they came from
+            self.set_text_column(model.SOURCE_COLUMN)
         self.set_reorderable(True)
         self.connect('key-press-event', self._keypress)
         self.connect('button-press-event', self._handle_doubleclick)
 
+        # Load thumbnails for the visible rows whenever they might change
+        self._thumbnail_update = None
+        for signal in ('row-changed', 'row-inserted', 'row-deleted',
+                'rows-reordered'):
+            model.connect(signal,
+                    lambda *_args: self._queue_thumbnail_update())
+        self.connect('size-allocate',
+                lambda *_args: self._queue_thumbnail_update())
+        self.connect('set-scroll-adjustments', self._set_adjustments)
+
+    def _set_adjustments(self, _wid, _hadjustment, vadjustment):
+        if vadjustment is not None:
+            vadjustment.connect('value-changed',
+                    lambda _adj: self._queue_thumbnail_update())
+
+    def _queue_thumbnail_update(self):
+        if self._thumbnail_update is None:
+            self._thumbnail_update = glib.idle_add(self._update_thumbnails)
+
+    def _update_thumbnails(self):
+        self._thumbnail_update = None
+        model = self.get_model()
+        visible = self.get_visible_range()
+        if model is not None and visible is not None:
+            start, end = visible
+            assert len(start) == len(end) == 1
+            model.load_thumbnails(start[0], end[0], _THUMBNAIL_PREFETCH)
+        return False
+
+    @contextmanager
+    def detached_model(self):
+        '''Detach the model while making bulk changes to it, so that the
+        view doesn't process each change separately.'''
+        model = self.get_model()
+        # We're always packed in a ScrolledWindow
+        adjustment = self.get_parent().get_vadjustment()
+        position = adjustment.get_value()
+        def restore_position():
+            adjustment.set_value(min(position,
+                    adjustment.upper - adjustment.page_size))
+            return False
+
+        self.set_model(None)
+        try:
+            yield model
+        finally:
+            self.set_model(model)
+            # Restore the scroll position once the view is laid out
+            glib.idle_add(restore_position)
+
     def _keypress(self, _wid, ev):
         state = ev.state & gtk.accelerator_get_default_mod_mask()
         if state == 0:
@@ -226,6 +291,14 @@ class _PageView(_ListIconView):
                     ev.keyval == gtk.gdk.keyval_from_name('Delete')):
                 self.emit('delete-selected')
                 return True
+        elif state == gtk.gdk.CONTROL_MASK:
+            if ev.keyval in (gtk.keysyms.plus, gtk.keysyms.equal,
+                    gtk.keysyms.KP_Add):
+                self.emit('zoom', 1)
+                return True
+            if ev.keyval in (gtk.keysyms.minus, gtk.keysyms.KP_Subtract):
+                self.emit('zoom', -1)
+                return True
         return False
 
     # gtk.gdk._2BUTTON_PRESS isn't protected, it's just badly named
@@ -392,8 +465,18 @@ class _Controls(gtk.Table):
 
 
 class _SaveView(gtk.TreeView):
+    __gsignals__ = {
+        'cancel': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (object,)),
+        'prioritize': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                (object,)),
+        'retry': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (object,)),
+    }
+
     def __init__(self, model):
         gtk.TreeView.__init__(self, model)
+        self.set_tooltip_text('Enter: retry failed job\n'
+                'Delete: cancel job\nCtrl+Up: save next')
+        self.connect('key-press-event', self._keypress)
 
         renderer = gtk.CellRendererText()
         renderer.set_property('width-chars', 25)
@@ -411,10 +494,40 @@ class _SaveView(gtk.TreeView):
         thread = model.get_value(iter, model.THREAD_COLUMN)
         cell.set_property('text', thread.filename)
 
+    def _keypress(self, _wid, ev):
+        model, iter = self.get_selection().get_selected()
+        if iter is None:
+            return False
+        thread = model.get_value(iter, model.THREAD_COLUMN)
+        state = ev.state & gtk.accelerator_get_default_mod_mask()
+        if state == 0 and ev.keyval in (gtk.keysyms.Delete,
+                gtk.keysyms.BackSpace):
+            self.emit('cancel', thread)
+            return True
+        if state == 0 and ev.keyval in (gtk.keysyms.Return,
+                gtk.keysyms.KP_Enter):
+            self.emit('retry', thread)
+            return True
+        if state == gtk.gdk.CONTROL_MASK and ev.keyval == gtk.keysyms.Up:
+            self.emit('prioritize', thread)
+            return True
+        return False
+
     @staticmethod
     def _render_progress(_column, cell, model, iter):
+        thread = model.get_value(iter, model.THREAD_COLUMN)
         count, total = model.get(iter, model.COUNT_COLUMN, model.TOTAL_COLUMN)
-        if total > 0:
+        if thread.cancelled:
+            cell.set_property('text', 'Cancelling...')
+            cell.set_property('value', 0)
+        elif thread.error is not None:
+            cell.set_property('text', 'Failed at %d/%d pages' %
+                    (count, total))
+            cell.set_property('value', 100 * count / total if total else 0)
+        elif not thread.started:
+            cell.set_property('text', 'Queued')
+            cell.set_property('value', 0)
+        elif total > 0:
             cell.set_property('text', '%d/%d pages' % (count, total))
             cell.set_property('value', 100 * count / total)
         else:
@@ -430,6 +543,12 @@ class MainWindow(gtk.Window):
         'settings-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
         'page-opened': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
                 (object,)),
+        'save-cancelled': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                (object,)),
+        'save-prioritized': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                (object,)),
+        'save-retried': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                (object,)),
     }
 
     def __init__(self, config, pagelist, savelist):
@@ -452,7 +571,8 @@ class MainWindow(gtk.Window):
         self._toolbar = _PageToolbar()
         vbox.pack_start(self._toolbar, expand=False)
 
-        self._pages = _PageView(pagelist)
+        self._pages = _PageView(pagelist,
+                show_source=len(config.devices) > 1)
         vbox.pack_start(make_scroller(self._pages))
 
         vbox = gtk.VBox(spacing=5)
@@ -474,6 +594,14 @@ class MainWindow(gtk.Window):
         self._pages.connect('selection-activated', lambda _wid: self._open())
         self._pages.connect('delete-selected',
                 lambda _wid: self._delete_selected())
+        self._pages.connect('zoom',
+                lambda _wid, direction: self._zoom_thumbnails(direction))
+        self._jobs.connect('cancel',
+                lambda _wid, thread: self._cancel_save(thread))
+        self._jobs.connect('retry',
+                lambda _wid, thread: self.emit('save-retried', thread))
+        self._jobs.connect('prioritize',
+                lambda _wid, thread: self.emit('save-prioritized', thread))
         self._controls.scan_button.connect('clicked',
                 lambda _wid: self.emit('scan'))
         self._controls.save_button.connect('clicked',
@@ -504,8 +632,20 @@ class MainWindow(gtk.Window):
 
     def _rotate(self, degrees):
         model = self._pages.get_model()
-        for path in self._pages.get_selected_items():
-            model.get_page(path).rotate(degrees)
+        model.rotate_pages(self._pages.get_selected_items(), degrees)
+
+    def _cancel_save(self, thread):
+        self.emit('save-cancelled', thread)
+        # Show the new status
+        self._jobs.queue_draw()
+
+    def _zoom_thumbnails(self, direction):
+        model = self._pages.get_model()
+        size = [int(round(a * _THUMBNAIL_ZOOM ** direction))
+                for a in model.thumbnail_size]
+        if (min(size) >= _MIN_THUMBNAIL_SIZE and
+                max(size) <= _MAX_THUMBNAIL_SIZE):
+            model.set_thumbnail_size(size)
 
     def _save(self):
         filename = self._controls.name_field.get_text()
@@ -518,9 +658,85 @@ class MainWindow(gtk.Window):
         self._controls.set_pages_selected(selected)
 
     def _delete_selected(self):
-        model = self._pages.get_model()
-        for path in sorted(self._pages.get_selected_items(), reverse=True):
-            model.remove_page(path)
+        paths = self._pages.get_selected_items()
+        with self._pages.detached_model() as model:
+            pages = model.remove_pages(paths)
+        for page in pages:
+            page.finish()
+
+
+class _TileLoader(threading.Thread):
+    '''Render tiles of a page in the background and pass them to a callback
+    on the UI thread.  The most recently requested tiles are rendered
+    first, and requests that have scrolled out of view are dropped.  A
+    request without a box renders the whole page, sampling every step'th
+    pixel.'''
+
+    def __init__(self, page, callback):
+        threading.Thread.__init__(self, name='tile-loader')
+        self.daemon = True
+        self._page = page
+        self._callback = callback
+        self._cond = threading.Condition()
+        self._requests = []
+        self._visible = None
+        self._stopping = False
+        # Pyramid level -> unrotated array, so that compressed page files
+        # are decoded once rather than for every tile.  Only touched by
+        # the loader thread.
+        self._arrays = {}
+
+    def request(self, key, box, level, step=1):
+        with self._cond:
+            self._requests.append((key, box, level, step))
+            self._cond.notify()
+
+    def set_visible(self, box):
+        with self._cond:
+            self._visible = box
+
+    def clear(self):
+        with self._cond:
+            del self._requests[:]
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+    def _is_visible(self, box):
+        if box is None or self._visible is None:
+            return True
+        left, top, right, bottom = box
+        vleft, vtop, vright, vbottom = self._visible
+        return (left < vright and vleft < right and top < vbottom and
+                vtop < bottom)
+
+    # We intentionally catch all exceptions
+    # pylint: disable=W0703
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._requests and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                key, box, level, step = self._requests.pop()
+                visible = self._is_visible(box)
+            pixbuf = None
+            if visible:
+                try:
+                    if level not in self._arrays:
+                        self._arrays[level] = \
+                                self._page.get_level(level).get_array()
+                    pixbuf = pixbuf_from_array(self._page.get_array(box,
+                            step, level, self._arrays[level]))
+                except Exception:
+                    # Page went away
+                    pass
+            # A None pixbuf tells the callback the tile was not loaded
+            glib.idle_add(self._callback, key, pixbuf)
+    # pylint: enable=W0703
 
 
 class PageWindow(gtk.Window):
@@ -528,6 +744,14 @@ class PageWindow(gtk.Window):
         'closed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
+    TILE_SIZE = 256
+    # Maximum dimension of the preview shown while tiles are loading
+    PREVIEW_SIZE = 1024
+    # Don't zoom out further than this
+    MIN_ZOOM_SIZE = 256
+    # Loaded tiles kept in memory, beyond those currently visible
+    MAX_TILES = 128
+
     def __init__(self, page):
         gtk.Window.__init__(self)
         self.set_title('Page View')
@@ -538,11 +762,22 @@ class PageWindow(gtk.Window):
         self._drag_base = None
         self._change_callback = page.connect('changed', self._page_changed)
 
-        self._image = gtk.Image()
-        self._image.set_from_pixbuf(page.pixbuf)
+        # (level, tile x, tile y) -> pixbuf, least recently drawn first
+        self._tiles = OrderedDict()
+        self._requested = set()
+        # Incremented whenever outstanding tile requests become stale
+        self._generation = 0
+        # Pyramid level being displayed
+        self._level = 0
+        self._loader = _TileLoader(page, self._tile_loaded)
+        self._loader.start()
+
+        self._area = gtk.DrawingArea()
+        self._area.connect('expose-event', self._expose)
+        self._reset()
 
         ebox = gtk.EventBox()
-        ebox.add(self._image)
+        ebox.add(self._area)
         ebox.connect('button-press-event', self._press)
         ebox.connect('button-release-event', self._release)
         ebox.connect('motion-notify-event', self._motion)
@@ -557,6 +792,10 @@ class PageWindow(gtk.Window):
         scroller.add_with_viewport(ebox)
         self._adjustments = (scroller.get_hadjustment(),
                 scroller.get_vadjustment())
+        for adjustment in self._adjustments:
+            adjustment.connect('value-changed',
+                    lambda _adj: self._update_visible())
+            adjustment.connect('changed', lambda _adj: self._update_visible())
         self.add(scroller)
         scroller.show_all()
 
@@ -568,6 +807,13 @@ class PageWindow(gtk.Window):
                 gtk.ACCEL_LOCKED, self._close_key)
         accels.connect_group(gtk.keysyms.Escape, 0,
                 gtk.ACCEL_LOCKED, self._close_key)
+        for keyval in (gtk.keysyms.plus, gtk.keysyms.equal,
+                gtk.keysyms.KP_Add):
+            accels.connect_group(keyval, 0, gtk.ACCEL_LOCKED,
+                    lambda *_args: self._zoom(-1))
+        for keyval in (gtk.keysyms.minus, gtk.keysyms.KP_Subtract):
+            accels.connect_group(keyval, 0, gtk.ACCEL_LOCKED,
+                    lambda *_args: self._zoom(1))
         self.add_accel_group(accels)
 
     def _press(self, _wid, ev):
@@ -590,8 +836,136 @@ class PageWindow(gtk.Window):
             for adjustment, value in zip(self._adjustments, values):
                 adjustment.set_value(value)
 
+    def _reset(self):
+        '''Cancel tile requests and show a downscaled preview of the page.
+        Tiles already loaded for the current level are reused.'''
+        self._generation += 1
+        self._requested.clear()
+        self._loader.clear()
+        self._size = self.page.get_size(self._level)
+        # The preview is sampled from the full-size image, so that it
+        # never waits for a pyramid level to be built
+        step = max(1, int(math.ceil(max(self.page.size) /
+                self.PREVIEW_SIZE)))
+        self._preview_step = step
+        if self.page.stored_image.mappable:
+            self._set_preview(pixbuf_from_array(
+                    self.page.get_array(step=step)), step)
+        else:
+            # Sampling would decode the whole page file on the UI thread,
+            # so start with the thumbnail and have the loader build the
+            # real preview
+            thumbnail = pixbuf_from_array(
+                    self.page.get_thumbnail_array(self.page.rotation))
+            self._set_preview(thumbnail,
+                    self.page.size[0] / thumbnail.get_width())
+            self._loader.request((self._generation, None, None), None, 0,
+                    step)
+        self._area.set_size_request(*self._size)
+        self._area.queue_draw()
+
+    def _set_preview(self, pixbuf, step):
+        '''Show pixbuf, with step full-size pixels per preview pixel,
+        while tiles are loading.'''
+        self._preview = pixbuf
+        # Displayed pixels per preview pixel
+        self._preview_scale = step / 2 ** self._level
+
+    def _update_visible(self):
+        x, y = [int(a.get_value()) for a in self._adjustments]
+        w, h = [int(a.page_size) for a in self._adjustments]
+        self._loader.set_visible((x, y, x + w, y + h))
+
+    def _tile_box(self, tx, ty):
+        width, height = self._size
+        size = self.TILE_SIZE
+        return (tx * size, ty * size, min((tx + 1) * size, width),
+                min((ty + 1) * size, height))
+
+    def _preview_tile(self, box):
+        '''Scale up the part of the preview corresponding to box.'''
+        left, top, right, bottom = box
+        scale = self._preview_scale
+        pw, ph = self._preview.get_width(), self._preview.get_height()
+        x = min(int(left / scale), pw - 1)
+        y = min(int(top / scale), ph - 1)
+        w = max(min(int(math.ceil(right / scale)), pw) - x, 1)
+        h = max(min(int(math.ceil(bottom / scale)), ph) - y, 1)
+        return self._preview.subpixbuf(x, y, w, h).scale_simple(
+                right - left, bottom - top, gtk.gdk.INTERP_BILINEAR)
+
+    def _expose(self, _wid, ev):
+        # Draw the tiles intersecting the exposed area, falling back to
+        # the preview for tiles that haven't been loaded yet
+        size = self.TILE_SIZE
+        width, height = self._size
+        area = ev.area
+        for ty in range(area.y // size,
+                min((area.y + area.height - 1) // size + 1,
+                -(-height // size))):
+            for tx in range(area.x // size,
+                    min((area.x + area.width - 1) // size + 1,
+                    -(-width // size))):
+                box = self._tile_box(tx, ty)
+                key = (self._level, tx, ty)
+                pixbuf = self._tiles.pop(key, None)
+                if pixbuf is not None:
+                    # Mark as recently used
+                    self._tiles[key] = pixbuf
+                else:
+                    pixbuf = self._preview_tile(box)
+                    if (tx, ty) not in self._requested:
+                        self._requested.add((tx, ty))
+                        self._loader.request((self._generation, tx, ty),
+                                box, self._level)
+                self._area.window.draw_pixbuf(None, pixbuf, 0, 0, box[0],
+                        box[1])
+        return True
+
+    def _tile_loaded(self, key, pixbuf):
+        generation, tx, ty = key
+        if generation != self._generation:
+            return False
+        if tx is None:
+            if pixbuf is not None:
+                self._set_preview(pixbuf, self._preview_step)
+                self._area.queue_draw()
+            return False
+        self._requested.discard((tx, ty))
+        if pixbuf is not None:
+            self._tiles[(self._level, tx, ty)] = pixbuf
+            self._evict_tiles()
+            left, top, right, bottom = self._tile_box(tx, ty)
+            self._area.queue_draw_area(left, top, right - left, bottom - top)
+        return False
+
+    def _evict_tiles(self):
+        '''Drop the least recently drawn tiles outside the viewport until
+        at most MAX_TILES of them remain.'''
+        x, y = [int(a.get_value()) for a in self._adjustments]
+        w, h = [int(a.page_size) for a in self._adjustments]
+        size = self.TILE_SIZE
+        def visible(key):
+            level, tx, ty = key
+            return (level == self._level and
+                    x // size <= tx <= (x + w) // size and
+                    y // size <= ty <= (y + h) // size)
+        hidden = [key for key in self._tiles if not visible(key)]
+        for key in hidden[:max(len(hidden) - self.MAX_TILES, 0)]:
+            del self._tiles[key]
+
+    def _zoom(self, delta):
+        level = self._level + delta
+        if level < 0 or max(self.page.get_size(level)) < self.MIN_ZOOM_SIZE:
+            return True
+        self._level = level
+        self._reset()
+        return True
+
     def _page_changed(self, _page):
-        self._image.set_from_pixbuf(self.page.pixbuf)
+        # Loaded tiles have the old rotation
+        self._tiles.clear()
+        self._reset()
 
     def _close_key(self, _group, _wid, _keyval, _modifier):
         self.emit('closed')
@@ -604,6 +978,7 @@ class PageWindow(gtk.Window):
     def _unrealize(self, _wid):
         self.page.disconnect(self._change_callback)
         self._change_callback = None
+        self._loader.stop()
 
 
 
@@ -9,6 +9,6 @@ setup(
     author_email='bgilbert@backtick.net',
     url='https://github.com/bgilbert/scanvark',
     packages=['scanvark'],
-    scripts=['tools/scanvark'],
+    scripts=['tools/scanvark', 'tools/scanvark-batch'],
     license='GPLv2',
 )